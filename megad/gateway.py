@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+import megad.megad
+import megad.mqtt
+
+############################################################################
+#               Wiring of MegaD and MQTT platforms together                #
+############################################################################
+
+
+class Gateway(object):
+    # used by the application as well as by soak and replay tools, which substitute the broker and devices
+    def __init__(self, loop, logger, config, connector=megad.mqtt.MQTTConnector, device_class=megad.megad.Device):
+        self.loop = loop
+        self.logger = logger
+        self.megad = megad.megad.Platform(loop, logger, config.get('megad', {}), self.on_megad_new_device,
+                                          self.on_megad_lost_device, self.on_megad_message, device_class)
+        self.mqtt = megad.mqtt.Platform(loop, logger, config.get('mqtt', {}), self.on_mqtt_message, self.get_ports,
+                                        self.on_mqtt_batch, connector)
+
+    def set_recorder(self, recorder):
+        self.megad.recorder = recorder
+        self.mqtt.set_recorder(recorder)
+
+    async def start(self):
+        await self.mqtt.start()
+        await self.megad.start()
+
+    async def stop(self):
+        await self.megad.stop()
+        await self.mqtt.stop()
+
+    async def reload(self, config):
+        await self.mqtt.reload(config.get('mqtt', {}))
+        await self.megad.reload(config.get('megad', {}))
+
+    def get_ports(self, device_id):
+        # descriptions of ports with their current values
+        device = self.megad.devices.devices.get(device_id)
+        return (device.ports if device is not None else None) or {}
+
+    async def on_megad_new_device(self, device_id):
+        await self.mqtt.publish_device(device_id, self.megad.devices.devices[device_id].ports)
+
+    async def on_megad_lost_device(self, device_id):
+        await self.mqtt.remove_device(device_id)
+
+    async def on_megad_message(self, device_id, port, value):
+        await self.mqtt.send_message(device_id, port, value)
+
+    async def on_mqtt_message(self, device_id, port, value):
+        await self.megad.send_message(device_id, port, value)
+
+    async def on_mqtt_batch(self, commands):
+        await self.megad.send_batch(commands)
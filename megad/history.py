@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+from array import array
+
+############################################################################
+#              Fixed size ring buffers of recent port values               #
+############################################################################
+
+
+HISTORY_DEFAULT_SIZE = 256  # samples per port
+HISTORY_DEFAULT_BUDGET = 1024 * 1024  # bytes for all ports of all devices
+HISTORY_DEFAULT_TEXT_SIZE = 128  # bytes of encoded text value, longer values are not stored
+HISTORY_MIN_SIZE = 8  # samples, ports are left without history if budget does not allow it
+
+# kinds of port values
+HISTORY_FLOAT = 'd'
+HISTORY_INT = 'q'
+HISTORY_SHORT_TEXT = 's'  # ON/OFF/LONG of inputs
+HISTORY_TEXT = 't'  # JSON of sensors
+HISTORY_SHORT_TEXT_SIZE = 8  # bytes
+
+TIME_SIZE = 8  # bytes of sample timestamp
+LENGTH_SIZE = 2  # bytes of text value length
+
+
+class PortHistory(object):
+    __slots__ = ('times', 'values', 'lengths', 'slot', 'interval', 'pos', 'count')
+
+    def __init__(self, size, typecode, slot, interval):
+        # numbers are kept in array of typecode, texts are kept UTF-8 encoded in fixed slots of bytearray
+        self.times = array('d', bytes(TIME_SIZE * size))
+        self.slot = slot
+        if slot:
+            self.values = bytearray(slot * size)
+            self.lengths = array('H', bytes(LENGTH_SIZE * size))
+        else:
+            self.values = array(typecode, bytes(array(typecode).itemsize * size))
+            self.lengths = None
+        self.interval = interval  # downsampling interval, 0 to keep every sample
+        self.pos = 0  # slot for the next sample
+        self.count = 0
+
+    @staticmethod
+    def sample_size(typecode, slot):
+        return TIME_SIZE + (slot + LENGTH_SIZE if slot else array(typecode).itemsize)
+
+    def _convert(self, value):
+        # returns value in stored form or None if it can't be stored
+        try:
+            if self.slot:
+                if not isinstance(value, str):
+                    return None
+                value = value.encode('utf-8')
+                return value if len(value) <= self.slot else None
+            return float(value) if self.values.typecode == HISTORY_FLOAT else int(value)
+        except (TypeError, ValueError):
+            return None
+
+    def _store(self, idx, value):
+        if self.slot:
+            start = idx * self.slot
+            self.values[start:start + len(value)] = value
+            self.lengths[idx] = len(value)
+        else:
+            self.values[idx] = value
+
+    def _load(self, idx):
+        if self.slot:
+            start = idx * self.slot
+            return self.values[start:start + self.lengths[idx]].decode('utf-8')
+        return self.values[idx]
+
+    def append(self, timestamp, value):
+        value = self._convert(value)
+        if value is None:
+            return
+        size = len(self.times)
+        if self.interval > 0 and self.count:
+            last = self.pos - 1 if self.pos else size - 1
+            if timestamp // self.interval == self.times[last] // self.interval:
+                # same downsampling interval, keep only the latest value
+                self.times[last] = timestamp
+                self._store(last, value)
+                return
+        self.times[self.pos] = timestamp
+        self._store(self.pos, value)
+        self.pos = self.pos + 1 if self.pos + 1 < size else 0
+        if self.count < size:
+            self.count += 1
+
+    def samples(self):
+        size = len(self.times)
+        start = self.pos - self.count
+        return [(self.times[i % size], self._load(i % size)) for i in range(start, start + self.count)]
+
+    @property
+    def memory(self):
+        return len(self.times) * self.sample_size(self.values.typecode if not self.slot else None, self.slot)
+
+
+class History(object):
+    def __init__(self, logger, config):
+        self.logger = logger
+        self.size = int(config.get('size', HISTORY_DEFAULT_SIZE))
+        self.budget = int(config.get('budget', HISTORY_DEFAULT_BUDGET))
+        self.interval = float(config.get('downsample', 0))
+        self.text_size = int(config.get('text_size', HISTORY_DEFAULT_TEXT_SIZE))
+        self.used = 0
+        self._exhausted = False
+
+    def allocate(self, kind, downsample):
+        # every sample, including encoded texts, is counted against the budget
+        if kind == HISTORY_TEXT:
+            typecode, slot = None, self.text_size
+        elif kind == HISTORY_SHORT_TEXT:
+            typecode, slot = None, HISTORY_SHORT_TEXT_SIZE
+        else:
+            typecode, slot = kind, 0
+        size = min(self.size, (self.budget - self.used) // PortHistory.sample_size(typecode, slot))
+        if size < HISTORY_MIN_SIZE:
+            if not self._exhausted:
+                self.logger.warning(f'History memory budget of {self.budget} bytes exhausted. '
+                                    f'Following ports have no history')
+                self._exhausted = True
+            return None
+        port_history = PortHistory(size, typecode, slot, self.interval if downsample else 0)
+        self.used += port_history.memory
+        return port_history
+
+    def release(self, port_history):
+        if port_history is not None:
+            self.used -= port_history.memory
+            self._exhausted = False
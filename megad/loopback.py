@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+import asyncio
+
+import megad.mqtt
+
+############################################################################
+#        Stand-ins for running the gateway without a broker, in tools      #
+############################################################################
+
+
+class LoopbackConnector(object):
+    # stand-in of MQTTConnector: counts published messages, remembers subscriptions
+    def __init__(self, loop, logger, config, async_on_connect, async_on_message):
+        self.loop = loop
+        self.logger = logger
+        self.async_on_connect_cb = async_on_connect
+        self.async_on_message_cb = async_on_message
+        self.connected = False
+        self.subscriptions = set()
+        self.published = 0
+
+    async def start(self):
+        self.connected = True
+        if self.async_on_connect_cb is not None:
+            self.loop.create_task(self.async_on_connect_cb())
+
+    async def stop(self):
+        self.connected = False
+
+    async def async_subscribe(self, topic, qos=megad.mqtt.MQTT_DEFAULT_QOS):
+        self.subscriptions.add(topic)
+
+    async def async_unsubscribe(self, topic):
+        self.subscriptions.discard(topic)
+
+    async def async_publish(self, topic, payload, qos=megad.mqtt.MQTT_DEFAULT_QOS, retain=megad.mqtt.MQTT_DEFAULT_RETAIN):
+        self.published += 1
+
+    async def inject(self, topic, payload):
+        await self.async_on_message_cb(topic, payload)
+
+
+async def cancel_tasks(loop):
+    # pooling loops have no stop of their own, the gateway process just exits, tools running it in-process
+    # cancel them after Gateway.stop() so the loop closes without destroyed pending tasks
+    pending = [task for task in asyncio.all_tasks(loop) if task is not asyncio.current_task(loop)]
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
@@ -1,15 +1,24 @@
 #!/usr/bin/env python3
 import asyncio
 import json
+import math
 import re
 import socket
+import time
+from array import array
 from enum import IntEnum
+from itertools import chain, islice
 
 import aiohttp
 import aiohttp.web
 import aiohttp.web_server
 import netifaces
 
+from megad.history import History, HISTORY_FLOAT, HISTORY_INT, HISTORY_SHORT_TEXT, HISTORY_TEXT
+
+
+MEGAD_MULTI_CMD_MAX = 8  # commands joined into one cmd= request
+
 
 class PortType(IntEnum):
     NC = 255
@@ -55,6 +64,51 @@ class PortI2CSDADevice(IntEnum):
     PCA9685 = 21
 
 
+class Port(object):
+    __slots__ = ('id', 'idx', 'pn', 'pty', 'm', 'd', 'name', 'type', 'extra')
+    FIELDS = ('pn', 'pty', 'm', 'd', 'name', 'type')
+
+    def __init__(self, props):
+        self.pn = props['pn']
+        self.id = f'p{self.pn}'
+        self.idx = self.pn  # index in device ports list
+        self.pty = props.get('pty')
+        self.m = props.get('m')
+        self.d = props.get('d')
+        self.name = props.get('name')
+        self.type = props.get('type')
+        # rest of port page attributes are kept only for templates matching, as flat (key, value, ...) tuple
+        self.extra = tuple(chain.from_iterable(kv for kv in props.items() if kv[0] not in self.FIELDS))
+
+    def description(self):
+        desc = {k: getattr(self, k) for k in self.FIELDS if getattr(self, k) is not None}
+        desc.update(zip(self.extra[::2], self.extra[1::2]))
+        return desc
+
+    @property
+    def commandable(self):
+        return self.pty == PortType.Out
+
+    def __repr__(self):
+        return f'{self.description()}'
+
+
+class ExtPort(Port):
+    # channel of I2C port expander, addressed by MegaD as <pn>e<ext>
+    __slots__ = ('ext',)
+    FIELDS = Port.FIELDS + ('ext',)
+
+    def __init__(self, parent, ext, idx):
+        super().__init__({'pn': parent.pn, 'd': parent.d, 'type': 'EXT', 'name': f'{parent.name} ext {ext}'})
+        self.ext = ext
+        self.id = f'p{self.pn}e{ext}'
+        self.idx = idx
+
+    @property
+    def commandable(self):
+        return True
+
+
 class Device(object):
     def _parse_port_html(self, response_body):
         def extract_attrs(s):
@@ -87,12 +141,12 @@ class Device(object):
         return props
 
     def _parse_port_value(self, port, value):
-        port_type = port.get('pty')
-        if port_type is None and port.get('type') == 'ADC':
+        port_type = port.pty
+        if port_type is None and port.type == 'ADC':
             # for MegaD-328
             port_type = PortType.ADC
-        port_mode = port.get('m')
-        port_dev = port.get('d')
+        port_mode = port.m
+        port_dev = port.d
 
         if value is None:
             return None
@@ -130,7 +184,7 @@ class Device(object):
                 if isinstance(value, int):
                     if value == 0 or value == 1:
                         return value
-            if port.get('m') == PortOutMode.PWM:
+            if port_mode == PortOutMode.PWM:
                 if isinstance(value, str):
                     value = int(value)
                 return value
@@ -162,30 +216,153 @@ class Device(object):
                     return float(value)
                 if port_dev == PortI2CSDADevice.TSL2591:
                     return float(value)
+                if port_dev in (PortI2CSDADevice.MCP230XX, PortI2CSDADevice.PCA9685):
+                    return None  # values are read per channel, see _parse_ext_value
             self.platform.logger.warning(f'Unknown port mode/device: {port}. Value of type {type(value)} unparsed: {value}')
             return value
 
         self.platform.logger.warning(f'Unknown port type: {port}. Value of type {type(value)} unparsed: {value}')
         return value
 
+    def _parse_ext_value(self, port, value):
+        # MCP230XX channels report ON/OFF, PCA9685 channels report PWM value
+        if value.startswith('OFF'):
+            return 0
+        if value.startswith('ON'):
+            return 1
+        if value.isnumeric():
+            return int(value)
+        if value == '':
+            return None
+        self.platform.logger.warning(f'Unknown expander channel value: {port}. Value unparsed: {value}')
+        return value
+
     async def _fetch(self, url):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    return await resp.text()
-        return ''
+        recorder = self.platform.recorder
+        started = time.monotonic()
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(url) as resp:
+                    body = await resp.text() if resp.status == 200 else ''
+        except Exception:
+            if recorder is not None:
+                recorder.fetch(url, None, started)
+            raise
+        if recorder is not None:
+            recorder.fetch(url, body, started)
+        return body
 
     def __init__(self, platform, config):
         self.platform = platform
         self.address = config['address']
         self.password = config['password']
         self.device_base_url = f'http://{self.address}/{self.password}/'
+        self.device_state_url = f'{self.device_base_url}?cmd=all'
         self.mega_cf_checked = False
         self.mega_id = None
         self.mega_cf = None
+        self.multi_cmd = False  # several commands in one request, e.g. cmd=7:1;8:0
         self.device_id = None
         self.device_name = None
-        self.ports = None
+        self.port_list = None  # indexed by port number, None for absent ports, then expanders channels
+        self.ports_count = 0  # physical ports in port_list
+        self.expanders = ()  # (port, channels) for I2C port expanders
+        self.values = None  # current values, indexed as port_list
+        self.changed = None  # time of last values change, indexed as port_list
+        self.history = None  # recent values of ports, indexed as port_list
+
+    @property
+    def ports(self):
+        if self.port_list is None:
+            return None
+        # I2C expander ports have no value of their own and are published as channels only
+        expanders = {port.idx for port, _ in self.expanders}
+        result = {}
+        for port, value in zip(self.port_list, self.values):
+            if port is not None and port.idx not in expanders:
+                result[port.id] = port.description()
+                if value is not None:
+                    result[port.id]['value'] = value
+        return result
+
+    def _set_value(self, idx, value):
+        now = time.time()
+        self.values[idx] = value
+        self.changed[idx] = now
+        if self.history is not None and self.history[idx] is not None:
+            self.history[idx].append(now, value)
+        self.platform.devices.snapshots.clear()
+
+    def _history_kind(self, port):
+        # returns (kind of values, downsample) or None for ports without values
+        if isinstance(port, ExtPort):
+            return HISTORY_INT, False
+        port_type = port.pty
+        if port_type is None and port.type == 'ADC':
+            port_type = PortType.ADC
+        if port_type == PortType.Out:
+            return HISTORY_INT, False
+        if port_type == PortType.ADC:
+            return HISTORY_FLOAT, True
+        if port_type == PortType.In:
+            return HISTORY_SHORT_TEXT, False
+        if port_type == PortType.I2C and port.m == PortI2CMode.SDA:
+            if port.d in (PortI2CSDADevice.MAX44009, PortI2CSDADevice.TSL2591):
+                return HISTORY_FLOAT, True
+            if port.d in (PortI2CSDADevice.MCP230XX, PortI2CSDADevice.PCA9685):
+                return None  # values are kept per channel
+            return HISTORY_TEXT, False
+        if port_type == PortType.DSen:
+            return HISTORY_TEXT, False
+        return None
+
+    def _allocate_history(self):
+        history = self.platform.devices.history
+        if history is None:
+            return
+        self.release_history()
+        self.history = []
+        for port in self.port_list:
+            kind = self._history_kind(port) if port is not None else None
+            self.history.append(history.allocate(*kind) if kind is not None else None)
+
+    def release_history(self):
+        if self.history is not None:
+            for port_history in self.history:
+                self.platform.devices.history.release(port_history)
+            self.history = None
+
+    def find_control(self, control):
+        # port accepting commands by its id, or None
+        if self.port_list is not None:
+            for port in self.port_list:
+                if port is not None and port.id == control:
+                    return port if port.commandable else None
+        return None
+
+    def _make_port_list(self, ports, expanders=()):
+        port_list = [None] * (max(ports.keys()) + 1 if ports else 0)
+        for pn, port in ports.items():
+            port_list[pn] = port
+        for _, channels in expanders:
+            port_list.extend(channels)
+        return port_list
+
+    async def _query_expanders(self, ports):
+        expanders = []
+        idx = max(ports.keys()) + 1 if ports else 0
+        for port in ports.values():
+            if port.pty == PortType.I2C and port.m == PortI2CMode.SDA and \
+                    port.d in (PortI2CSDADevice.MCP230XX, PortI2CSDADevice.PCA9685):
+                ext_state = await self._fetch(self.device_base_url + f'?pt={port.pn}&cmd=get')
+                if not ext_state:
+                    self.platform.logger.warning(f'No channels of port expander received from address '
+                                                 f'{self.address} port {port.pn}')
+                    continue
+                channels = tuple(ExtPort(port, ext, idx + ext) for ext in range(len(ext_state.split(';'))))
+                idx += len(channels)
+                expanders.append((port, channels))
+        return expanders
 
     async def query_device(self):
         try:
@@ -215,7 +392,7 @@ class Device(object):
                     port_props['name'] = it.group(2)
                     port_props['type'] = it.group(3)
                     if 'pn' in port_props:
-                        ports[f'p{port_props["pn"]}'] = port_props
+                        ports[port_props['pn']] = Port(port_props)
                     else:
                         self.platform.logger.warning(f'incorrect or unsupported port description received from '
                                                      f'address http://{self.address}{it.group(1)}')
@@ -228,13 +405,20 @@ class Device(object):
                         port_props['name'] = it.group(2)
                         port_props['type'] = it.group(3)
                         if 'pn' in port_props:
-                            ports[f'p{port_props["pn"]}'] = port_props
-                            self.platform.logger.debug(f'Query device: Device: {self.device_id} Port: {port_props}')
+                            ports[port_props['pn']] = Port(port_props)
+                            self.platform.logger.debug('Query device: Device: %s Port: %s', self.device_id, port_props)
                         else:
                             self.platform.logger.warning(f'incorrect or unsupported port description received from '
                                                          f'address http://{self.address}{it.group(1)}')
 
-            self.mega_id, self.mega_cf, self.ports = megaid, megacf, ports
+            self.mega_id, self.mega_cf = megaid, megacf
+            self.multi_cmd = megaver == 2561
+            self.expanders = await self._query_expanders(ports)
+            self.ports_count = max(ports.keys()) + 1 if ports else 0
+            self.port_list = self._make_port_list(ports, self.expanders)
+            self.values = [None] * len(self.port_list)
+            self.changed = array('d', bytes(8 * len(self.port_list)))
+            self._allocate_history()
             if self.device_id is None:
                 self.device_id = f'megad_{self.mega_id}'
             if self.device_name is None:
@@ -242,7 +426,9 @@ class Device(object):
 
             await self.pool()
         except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-            self.mega_id, self.mega_cf, self.ports = None, None, None
+            self.release_history()
+            self.mega_id, self.mega_cf, self.port_list, self.values, self.changed = None, None, None, None, None
+            self.ports_count, self.expanders = 0, ()
             self.device_id, self.device_name = None, None
 
     def check_config(self):
@@ -262,56 +448,74 @@ class Device(object):
         return result
 
     async def pool(self):
+        # returns indexes of updated ports
         updated = set()
-        state = await self._fetch(self.device_base_url + '?cmd=all')
-        for idx, val in enumerate(state.split(';')):
-            p_name = f'p{idx}'
-            if p_name in self.ports:
-                cur_port = self.ports[p_name]
-                val = self._parse_port_value(cur_port, val)
-                if val is not None and ('value' not in cur_port or cur_port['value'] != val):
-                    cur_port['value'] = val
-                    updated.add(p_name)
+        port_list, values = self.port_list, self.values
+        state = await self._fetch(self.device_state_url)
+        for port, val in zip(islice(port_list, self.ports_count), state.split(';')):
+            if port is not None:
+                val = self._parse_port_value(port, val)
+                if val is not None and values[port.idx] != val:
+                    self._set_value(port.idx, val)
+                    updated.add(port.idx)
 
         # ports does not transmitted in cmd=all response
-        for p_name, cur_port in self.ports.items():
-            if cur_port.get('pty') == PortType.DSen and cur_port.get('d') == PortDSenDevice.OneWBUS:
-                val = await self._fetch(self.device_base_url + f'?pt={cur_port["pn"]}&cmd=list')
-                val = self._parse_port_value(cur_port, val)
-                if val is not None and ('value' not in cur_port or cur_port['value'] != val):
-                    cur_port['value'] = val
-                    updated.add(p_name)
+        for port in islice(port_list, self.ports_count):
+            if port is not None and port.pty == PortType.DSen and port.d == PortDSenDevice.OneWBUS:
+                val = await self._fetch(self.device_base_url + f'?pt={port.pn}&cmd=list')
+                val = self._parse_port_value(port, val)
+                if val is not None and values[port.idx] != val:
+                    self._set_value(port.idx, val)
+                    updated.add(port.idx)
+
+        # channels of port expanders, one request per expander
+        for port, channels in self.expanders:
+            ext_state = await self._fetch(self.device_base_url + f'?pt={port.pn}&cmd=get')
+            for channel, val in zip(channels, ext_state.split(';')):
+                val = self._parse_ext_value(channel, val)
+                if val is not None and values[channel.idx] != val:
+                    self._set_value(channel.idx, val)
+                    updated.add(channel.idx)
 
         return updated
 
-    async def send_message(self, control, command):
-        self.platform.logger.debug(f'Send message to device {self.device_id} for control {control} with command {command}')
+    async def _send_cmd(self, cmd):
+        # through _fetch, so commands are captured as well
+        response = await self._fetch(f'{self.device_base_url}?cmd={cmd}')
+        if response == 'Done':
+            self.platform.logger.debug('Message sent successfully')
+            return True
+        self.platform.logger.warning(f'Unexpected result at send message to device {self.device_id} with '
+                                     f'command {cmd}. Response text: {response}')
+        return False
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f'{self.device_base_url}?cmd={control[1:]}:{command}') as resp:
-                if resp.status != 200:
-                    self.platform.logger.warning(f'Error at send message to device {self.device_id} for control '
-                                                 f'{control} with command {command}. Response: {resp}')
-                    return None
-                ports_html = await resp.text()
-                if ports_html == 'Done':
-                    self.platform.logger.debug(f'Message sent successfully')
-                    return command
-                self.platform.logger.warning(f'Unexpected result at send message to device {self.device_id} for control'
-                                             f' {control} with command {command}. Response text: {ports_html}')
+    async def send_message(self, control, command):
+        self.platform.logger.debug('Send message to device %s for control %s with command %s', self.device_id, control, command)
+        if await self._send_cmd(f'{control[1:]}:{command}'):
+            return command
         return None
 
+    async def send_commands(self, commands):
+        self.platform.logger.debug('Send messages to device %s: %s', self.device_id, commands)
+        if not self.multi_cmd:
+            for control, command in commands:
+                await self.send_message(control, command)
+            return
+        for idx in range(0, len(commands), MEGAD_MULTI_CMD_MAX):
+            await self._send_cmd(';'.join(f'{control[1:]}:{command}'
+                                          for control, command in commands[idx:idx + MEGAD_MULTI_CMD_MAX]))
+
     async def parse_message(self, parameters):
-        self.platform.logger.debug(f'Message from MegaD {self.device_id} with parameters={parameters}')
-        port_id = f'p{parameters.get("pt", "")}'
-        cur_port = self.ports.get(port_id, None)
+        self.platform.logger.debug('Message from MegaD %s with parameters=%s', self.device_id, parameters)
+        pt = parameters.get('pt', '')
+        cur_port = self.port_list[int(pt)] if pt.isdecimal() and int(pt) < self.ports_count else None
         if cur_port is not None:
-            if cur_port.get('pty') == PortType.In:
+            if cur_port.pty == PortType.In:
                 value = self._parse_port_value(cur_port, int(parameters.get('m', 0)))
                 if value:
-                    cur_port['value'] = value
+                    self._set_value(cur_port.idx, value)
                     if self.platform.on_state_changed:
-                        await self.platform.on_state_changed(self.device_id, port_id, value)
+                        await self.platform.on_state_changed(self.device_id, cur_port.id, value)
                     return
         self.platform.logger.warning(f'Unknown message from MegaD with parameters={parameters}')
 
@@ -353,19 +557,26 @@ class DevicesSet(object):
         self.scap_password = config.get('scan', {}).get('password', 'sec')
         self.scan_transports = {}
 
-        cf_devices = config.get('devices', [])
+        self.cf_devices = self._config_devices(config)
+        self.snapshots = {}  # cached JSON state responses, cleared on every change
+        self.history = History(self.platform.logger, config['history']) if 'history' in config else None
         self.devices = {}
         self.disabled_devices = []
-        for cf_dev in cf_devices:
-            dev = Device(self.platform, cf_dev)
+        self.lock = asyncio.Lock()  # reload and enabling of disabled devices change devices lists one at a time
+        for address, password in self.cf_devices:
+            dev = self.platform.device_class(self.platform, {'address': address, 'password': password})
             self.disabled_devices.append(dev)
             self.platform.logger.info('Device {} added as disabled'.format(dev.address))
 
+    def _config_devices(self, config):
+        return [(cf_dev['address'], cf_dev['password']) for cf_dev in config.get('devices', [])]
+
     async def discovery(self):
         if not self.scan_enabled:
             return set()
 
         # send broadcast messages for megadevices discovery
+        scan_addrs = set()
         for iface in self.scan_interfaces or netifaces.interfaces():
             ifaddrs = netifaces.ifaddresses(iface)
             if netifaces.AF_INET not in ifaddrs:
@@ -373,6 +584,7 @@ class DevicesSet(object):
             for ifaddr in ifaddrs[netifaces.AF_INET]:
                 if 'broadcast' not in ifaddr:
                     continue
+                scan_addrs.add(ifaddr['addr'])
                 if ifaddr['addr'] in self.scan_transports:
                     self.scan_transports[ifaddr['addr']][1].send_discovery()
                 else:
@@ -382,6 +594,11 @@ class DevicesSet(object):
                     self.scan_transports[ifaddr['addr']] = (transport, protocol)
                     protocol.send_discovery()
 
+        # close transports of disappeared interface addresses
+        for addr in list(self.scan_transports):
+            if addr not in scan_addrs:
+                self.scan_transports.pop(addr)[0].close()
+
         # wait for response of all devices
         await asyncio.sleep(2)
 
@@ -393,38 +610,86 @@ class DevicesSet(object):
 
     async def check_disabled(self):
         scan_devices = await self.discovery()
-        for sdev in scan_devices:
-            found = False
-            for _, dev in self.devices.items():
-                if sdev == dev.address:
-                    found = True
-            for dev in self.disabled_devices:
-                if sdev == dev.address:
-                    found = True
-            if not found:
-                new_dev = Device(self.platform, {'address': sdev, 'password': self.scap_password})
-                self.disabled_devices.append(new_dev)
-                self.platform.logger.info(f'Found new device {new_dev.address}. Added as disabled')
-
-        await asyncio.gather(*[dev.query_device() for dev in self.disabled_devices])
-
-        for dev in self.disabled_devices.copy():  # make list copy to use remove inside the loop
-            if dev.device_id is not None:
+        async with self.lock:
+            for sdev in scan_devices:
+                found = False
+                for _, dev in self.devices.items():
+                    if sdev == dev.address:
+                        found = True
+                for dev in self.disabled_devices:
+                    if sdev == dev.address:
+                        found = True
+                if not found:
+                    new_dev = self.platform.device_class(self.platform,
+                                                         {'address': sdev, 'password': self.scap_password})
+                    self.disabled_devices.append(new_dev)
+                    self.platform.logger.info(f'Found new device {new_dev.address}. Added as disabled')
+
+            # forget found earlier devices which are not answering anymore, configured ones are kept
+            for dev in self.disabled_devices.copy():
+                if dev.address not in scan_devices and (dev.address, dev.password) not in self.cf_devices:
+                    self.disabled_devices.remove(dev)
+                    self.platform.logger.info(f'Device {dev.address} is not found anymore. Removed')
+
+            await self.enable_devices(self.disabled_devices.copy())
+
+    async def enable_devices(self, devices):
+        await asyncio.gather(*[dev.query_device() for dev in devices])
+
+        for dev in devices:
+            if dev.device_id is not None and dev in self.disabled_devices:
                 self.devices[dev.device_id] = dev
+                self.snapshots.clear()
                 self.disabled_devices.remove(dev)
                 self.platform.logger.info(f'Device enabled {dev.device_id}')
                 if self.platform.on_device_found:
                     await self.platform.on_device_found(dev.device_id)
 
+    async def reload(self, config):
+        async with self.lock:
+            self.scan_enabled = bool(config.get('scan', {}).get('enabled', 'true'))
+            self.scan_interfaces = config.get('scan', {}).get('interfaces')
+            self.scap_password = config.get('scan', {}).get('password', 'sec')
+
+            cf_devices = self._config_devices(config)
+            removed = [cf_dev for cf_dev in self.cf_devices if cf_dev not in cf_devices]
+            added = [cf_dev for cf_dev in cf_devices if cf_dev not in self.cf_devices]
+            self.cf_devices = cf_devices
+
+            for dev in self.disabled_devices.copy():
+                if (dev.address, dev.password) in removed:
+                    self.disabled_devices.remove(dev)
+                    self.platform.logger.info(f'Disabled device {dev.address} removed')
+            for megad_id, dev in list(self.devices.items()):
+                if (dev.address, dev.password) in removed:
+                    del self.devices[megad_id]
+                    dev.release_history()
+                    self.snapshots.clear()
+                    self.platform.logger.info(f'Device removed {megad_id}')
+                    if self.platform.on_device_lost:
+                        await self.platform.on_device_lost(megad_id)
+
+            known = [dev.address for dev in self.devices.values()] + [dev.address for dev in self.disabled_devices]
+            new_devices = []
+            for address, password in added:
+                if address in known:
+                    continue
+                dev = self.platform.device_class(self.platform, {'address': address, 'password': password})
+                self.disabled_devices.append(dev)
+                new_devices.append(dev)
+                self.platform.logger.info(f'Device {dev.address} added as disabled')
+            await self.enable_devices(new_devices)
+
     async def pool(self, device_id=None):
         result = set()
         try:
-            for megad_id, dev in self.devices.items():
+            for megad_id, dev in list(self.devices.items()):
                 if device_id is None or dev.device_id == device_id:
                     updated = await dev.pool()
-                    for port_id in updated:
+                    for idx in updated:
+                        port_id = dev.port_list[idx].id
                         if self.platform.on_state_changed:
-                            await self.platform.on_state_changed(dev.device_id, port_id, dev.ports[port_id]['value'])
+                            await self.platform.on_state_changed(dev.device_id, port_id, dev.values[idx])
                         result.add((dev.device_id, port_id))
         except Exception as e:
             self.platform.logger.exception(f'Exception on HTTP MegaD message processing. Exception type: {type(e)} message: {e}')
@@ -433,8 +698,71 @@ class DevicesSet(object):
     async def send_message(self, device, control, command):
         await self.devices[device].send_message(control, command)
 
+    async def send_batch(self, commands):
+        # returns controls of every device commands were sent to
+        per_device = {}
+        for device, control, command in commands:
+            if device not in self.devices:
+                self.platform.logger.warning(f'Batch command for unknown device {device} skipped')
+            elif self.devices[device].find_control(control) is None:
+                self.platform.logger.warning(f'Batch command for device {device} skipped. '
+                                             f'Port {control} is unknown or does not accept commands')
+            else:
+                per_device.setdefault(device, []).append((control, command))
+        results = await asyncio.gather(*[self.devices[device].send_commands(device_commands)
+                                         for device, device_commands in per_device.items()], return_exceptions=True)
+        for device, result in zip(per_device, results):
+            if isinstance(result, Exception):
+                self.platform.logger.error(f'Error at send batch to device {device}. Exception type: {type(result)} '
+                                           f'message: {result}')
+        return {device: frozenset(control for control, _ in device_commands)
+                for device, device_commands in per_device.items()}
+
+    def _device_state(self, dev):
+        return {'address': dev.address, 'name': dev.device_name,
+                'ports': {port.id: self._port_state(dev, port) for port in dev.port_list if port is not None}}
+
+    def _port_state(self, dev, port):
+        changed = dev.changed[port.idx]
+        return {'value': dev.values[port.idx], 'changed': changed if changed > 0 else None}
+
+    def snapshot(self, device_id=None, port_id=None):
+        # returns JSON of current state or None for unknown device or port
+        key = (device_id, port_id)
+        if key not in self.snapshots:
+            if device_id is None:
+                state = {dev_id: self._device_state(dev) for dev_id, dev in self.devices.items()}
+            elif device_id not in self.devices:
+                return None
+            elif port_id is None:
+                state = self._device_state(self.devices[device_id])
+            else:
+                dev = self.devices[device_id]
+                port = next((port for port in dev.port_list if port is not None and port.id == port_id), None)
+                if port is None:
+                    return None
+                state = self._port_state(dev, port)
+            self.snapshots[key] = json.dumps(state).encode('utf-8')
+        return self.snapshots[key]
+
+    def history_snapshot(self, device_id, port_id=None):
+        # returns JSON of recent port values or None for unknown device or port
+        key = ('history', device_id, port_id)
+        if key not in self.snapshots:
+            dev = self.devices.get(device_id)
+            if dev is None or dev.history is None:
+                return None
+            state = {port.id: port_history.samples() for port, port_history in zip(dev.port_list, dev.history)
+                     if port_history is not None and (port_id is None or port.id == port_id)}
+            if port_id is not None:
+                if port_id not in state:
+                    return None
+                state = state[port_id]
+            self.snapshots[key] = json.dumps(state).encode('utf-8')
+        return self.snapshots[key]
+
     async def parse_message(self, address, parameters):
-        self.platform.logger.debug(f'HTTP message from {address} with parameters {parameters}')
+        self.platform.logger.debug('HTTP message from %s with parameters %s', address, parameters)
         dev = self.devices.get(f'megad_{address.replace(".", "_")}', None)
         if dev:
             await dev.parse_message(parameters)
@@ -445,6 +773,8 @@ class Server(object):
         self.platform = platform
         self.address = config.get('address', '0.0.0.0')
         self.port = config.get('port', '19780')
+        self.state_api = bool(config.get('state_api', True))
+        self.profiler = None  # set by application to enable /profile
         self.server_http = aiohttp.web_server.Server(self.handler, loop=self.platform.loop)
         self.server_socket = None
 
@@ -458,15 +788,53 @@ class Server(object):
         self.server_socket = None
         self.platform.logger.debug("HTTP Server stopped.")
 
+    def state_handler(self, request):
+        # /state, /state/<device_id>, /state/<device_id>/<port_id>, /history/<device_id>, /history/<device_id>/<port_id>
+        if request.method != 'GET':
+            return aiohttp.web.HTTPMethodNotAllowed(request.method, ['GET'])
+        path = request.rel_url.path.strip('/').split('/')
+        if len(path) > 3 or (path[0] == 'history' and len(path) < 2):
+            return aiohttp.web.HTTPNotFound(text='ERROR: Incorrect path')
+        if path[0] == 'history':
+            body = self.platform.devices.history_snapshot(*path[1:])
+        else:
+            body = self.platform.devices.snapshot(*path[1:])
+        if body is None:
+            return aiohttp.web.HTTPNotFound(text='ERROR: Unknown device or port')
+        return aiohttp.web.Response(body=body, content_type='application/json')
+
+    def profile_handler(self, request):
+        # /profile?duration=<seconds>, configured duration if it is absent
+        if request.method != 'GET':
+            return aiohttp.web.HTTPMethodNotAllowed(request.method, ['GET'])
+        duration = request.rel_url.query.get('duration')
+        if duration is not None:
+            try:
+                duration = float(duration)
+            except ValueError:
+                duration = None
+            if duration is None or not math.isfinite(duration) or duration <= 0:
+                return aiohttp.web.HTTPBadRequest(text='ERROR: Incorrect duration')
+        report_path = self.profiler.start(duration)
+        if report_path is None:
+            return aiohttp.web.HTTPConflict(text='ERROR: Profiling is already running')
+        return aiohttp.web.json_response({'report': report_path})
+
     async def handler(self, request):
         from aiohttp.tcp_helpers import tcp_cork, tcp_nodelay
 
+        if self.state_api and request.rel_url.path.split('/')[1] in ('state', 'history'):
+            return self.state_handler(request)
+        if self.profiler is not None and request.rel_url.path == '/profile':
+            return self.profile_handler(request)
         if request.rel_url.path != '/megad':
             return aiohttp.web.Response(text="ERROR: Incorrect path")
         peername = request.transport.get_extra_info('peername')
         if peername is None:
             return aiohttp.web.Response(text="ERROR: Internal error - unknown remote address of peer")
         host, port = peername
+        if self.platform.recorder is not None:
+            self.platform.recorder.callback(host, request.rel_url.query_string)
         await self.platform.devices.parse_message(host, request.rel_url.query)
 
         # need to send headers and body in one packet as required by MegaD-328
@@ -478,14 +846,18 @@ class Server(object):
 
 
 class Platform:
-    def __init__(self, loop, logger, config, on_device_found, on_device_lost, on_state_changed):
+    def __init__(self, loop, logger, config, on_device_found, on_device_lost, on_state_changed, device_class=Device):
         self.server = None
         self.loop = loop
         self.logger = logger
+        self.device_class = device_class
+        self.recorder = None  # set by application to capture device responses and callbacks
         self.devices = DevicesSet(self, config)
         self.server = Server(self, config.get('server', {}))
         self.pool_interval = float(config.get('pool', 0))
         self.pool_state_interval = float(config.get('pool_state', 0.1))
+        self.state_pooling = {}  # device -> controls of running state pooling
+        self.state_pooling_fresh = set()  # devices with controls added after last state pooling started
 
         self.on_device_found = on_device_found
         self.on_device_lost = on_device_lost
@@ -495,7 +867,7 @@ class Platform:
         async def pool():
             await self.devices.check_disabled()
             await self.devices.pool()
-            if self.loop.is_running():
+            if self.loop.is_running() and self.pool_interval > 0:
                 self.loop.call_later(self.pool_interval, self._async_pooling)
 
         self.loop.create_task(pool())
@@ -508,15 +880,48 @@ class Platform:
     async def stop(self):
         await self.server.stop()
 
-    def _async_state_pooling(self, device, control):
+    async def reload(self, config):
+        server_config = config.get('server', {})
+        if server_config.get('address', '0.0.0.0') != self.server.address or \
+                server_config.get('port', '19780') != self.server.port:
+            self.logger.warning('MegaD server address changed. Restart required to apply it')
+        pool_interval = float(config.get('pool', 0))
+        if self.pool_interval <= 0 < pool_interval:
+            self.loop.call_soon(self._async_pooling)
+        self.pool_interval = pool_interval
+        self.pool_state_interval = float(config.get('pool_state', 0.1))
+        await self.devices.reload(config)
+
+    def _async_state_pooling(self, device, controls):
+        # only one state pooling per device, commands sent meanwhile are joined to the running one
+        if device in self.state_pooling:
+            self.state_pooling[device].update(controls)
+            self.state_pooling_fresh.add(device)
+            return
+        self.state_pooling[device] = set(controls)
+
         async def pool():
-            changed = await self.devices.pool(device)
-            if (device, control) in changed and self.loop.is_running():
-                self.loop.call_later(self.pool_state_interval, self._async_state_pooling, device, control)
+            try:
+                while self.loop.is_running():
+                    self.state_pooling_fresh.discard(device)
+                    changed = await self.devices.pool(device)
+                    if device not in self.state_pooling_fresh and \
+                            not any((device, control) in changed for control in self.state_pooling[device]):
+                        break
+                    await asyncio.sleep(self.pool_state_interval)
+            finally:
+                self.state_pooling.pop(device, None)
+                self.state_pooling_fresh.discard(device)
 
         self.loop.create_task(pool())
 
     async def send_message(self, device, control, message):
         await self.devices.send_message(device, control, message)
         if self.pool_state_interval > 0:
-            self.loop.call_soon(self._async_state_pooling, device, control)    
+            self.loop.call_soon(self._async_state_pooling, device, (control,))
+
+    async def send_batch(self, commands):
+        sent = await self.devices.send_batch(commands)
+        if self.pool_state_interval > 0:
+            for device, controls in sent.items():
+                self.loop.call_soon(self._async_state_pooling, device, controls)
@@ -4,11 +4,13 @@ import asyncio
 import json
 import logging
 import logging.handlers
+import queue
 import signal
 import sys
 
-import megad.megad
-import megad.mqtt
+import megad.gateway
+import megad.profiling
+import megad.recorder
 
 
 class StdStreamLogger(object):
@@ -24,18 +26,59 @@ class StdStreamLogger(object):
         pass
 
 
+class QueueLogHandler(logging.handlers.QueueHandler):
+    @staticmethod
+    def _freeze(arg):
+        return arg if arg is None or isinstance(arg, (str, int, float)) else repr(arg)
+
+    def prepare(self, record):
+        # message is formatted by the writer thread, not at the event loop. Mutable arguments are
+        # replaced by their current representation, as the loop may change them before formatting
+        if isinstance(record.args, dict):
+            record.args = {key: self._freeze(arg) for key, arg in record.args.items()}
+        elif record.args:
+            record.args = tuple(self._freeze(arg) for arg in record.args)
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    # passes only every N-th debug record of subsystem: {"megad": 10, "mqtt.publish_device": 100}
+    def __init__(self, sampling):
+        super().__init__()
+        self.rates = {}
+        for key, rate in sampling.items():
+            module, _, func = key.partition('.')
+            self.rates[(module, func or None)] = int(rate)
+        self.counters = {}
+
+    def filter(self, record):
+        if record.levelno != logging.DEBUG:
+            return True
+        key = (record.module, record.funcName)
+        rate = self.rates.get(key)
+        if rate is None:
+            key = (record.module, None)
+            rate = self.rates.get(key)
+            if rate is None:
+                return True
+        counter = self.counters.get(key, 0)
+        self.counters[key] = counter + 1
+        return counter % rate == 0
+
+
 class Main:
     def __init__(self):
         parser = argparse.ArgumentParser(description='MQTT (HomeAssistant, WirenBoard, etc.) driver for MegaDevices (ab-log.ru).')
         parser.add_argument('--config', default='/etc/megad-mqtt-gw.conf', help='name of configuration file')
         parser.add_argument('--log', default='/var/log/megad-mqtt-gw.log', help='name of log file')
         parser.add_argument('--debug', action='store_true', default=False, help='output more information to log and console')
+        parser.add_argument('--record', default=None, help='capture devices and MQTT traffic to file for replay')
         args = parser.parse_args()
 
-        try:
-            self.config = json.load(open(args.config, 'rt', encoding='utf-8'))
-        except Exception as e:
-            raise RuntimeError(f'Can\'t load configuration from path "{args.config}". Exception type: {type(e)} message: {e}')
+        self.config_path = args.config
+        self.config = self.load_config()
+        self.reload_task = None
+        self.reload_requested = False  # SIGHUP received while reloading
 
         try:
             self.logger = logging.getLogger(__name__)
@@ -43,11 +86,20 @@ class Main:
             handler = logging.handlers.TimedRotatingFileHandler(args.log, when='midnight', backupCount=3)
             formatter = logging.Formatter('%(asctime)s %(levelname)-8s %(message)s')
             handler.setFormatter(formatter)
-            self.logger.addHandler(handler)
+            handlers = [handler]
             if args.debug:
                 handler_console = logging.StreamHandler(sys.stdout)
                 handler_console.setFormatter(formatter)
-                self.logger.addHandler(handler_console)
+                handlers.append(handler_console)
+            # records are written by separate thread to keep disk I/O off the event loop
+            log_queue = queue.Queue(-1)
+            self.log_listener = logging.handlers.QueueListener(log_queue, *handlers)
+            self.log_handler = QueueLogHandler(log_queue)
+            sampling = self.config.get('log', {}).get('sampling', {})
+            if sampling:
+                self.log_handler.addFilter(SamplingFilter(sampling))
+            self.logger.addHandler(self.log_handler)
+            self.log_listener.start()
             sys.stdout = StdStreamLogger(self.logger, logging.INFO)
             sys.stderr = StdStreamLogger(self.logger, logging.ERROR)
 
@@ -59,39 +111,74 @@ class Main:
 
         try:
             self.logger.info('Creating platforms')
-            self.megad = megad.megad.Platform(self.loop, self.logger, self.config.get('megad', {}),
-                                              self.on_megad_new_device, self.on_megad_lost_device,
-                                              self.on_megad_message)
-            self.mqtt = megad.mqtt.Platform(self.loop, self.logger, self.config.get('mqtt', {}),
-                                            self.on_mqtt_message)
+            self.gateway = megad.gateway.Gateway(self.loop, self.logger, self.config)
+            profile_config = self.config.get('profile', {})
+            self.profiler = megad.profiling.Profiler(self.loop, self.logger, profile_config)
+            if profile_config.get('http', False):
+                self.gateway.megad.server.profiler = self.profiler
+            self.recorder = megad.recorder.Recorder(self.logger, args.record) if args.record else None
+            self.gateway.set_recorder(self.recorder)
         except Exception as e:
             self.logger.exception(f'Error at creating platforms. Exception type: {type(e)} message: {e}')
+            self.stop_logging()  # run() is not called, so queued records are written here
             raise RuntimeError(f'Error at creating platforms. Exception type: {type(e)} message: {e}')
 
+    def load_config(self):
+        try:
+            return json.load(open(self.config_path, 'rt', encoding='utf-8'))
+        except Exception as e:
+            raise RuntimeError(f'Can\'t load configuration from path "{self.config_path}". Exception type: {type(e)} message: {e}')
+
     async def start(self):
-        await self.mqtt.start()
-        await self.megad.start()
+        await self.gateway.start()
 
     async def stop(self):
-        await self.megad.stop()
-        await self.mqtt.stop()
+        await self.gateway.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    async def reload(self):
+        while True:
+            self.reload_requested = False
+            self.logger.info('Reloading configuration')
+            try:
+                config = self.load_config()
+                await self.gateway.reload(config)
+                self.config = config
+                self.logger.info('Configuration reloaded')
+            except Exception as e:
+                self.logger.exception(f'Error at reloading configuration. Exception type: {type(e)} message: {e}')
+            if not self.reload_requested:
+                break
 
     def signal_exit(self):
         self.loop.stop()
 
-    async def on_megad_new_device(self, device_id):
-        await self.mqtt.publish_device(device_id, self.megad.devices.devices[device_id].ports)
-
-    async def on_megad_lost_device(self, device_id):
-        pass
-
-    async def on_megad_message(self, device_id, port, value):
-        await self.mqtt.send_message(device_id, port, value)
-
-    async def on_mqtt_message(self, device_id, port, value):
-        await self.megad.send_message(device_id, port, value)
+    def signal_reload(self):
+        if self.reload_task is not None and not self.reload_task.done():
+            # configuration file may be changed again, so it is reloaded once more after the running reload
+            self.logger.info('Reload is in progress. Next reload is queued')
+            self.reload_requested = True
+            return
+        self.reload_task = self.loop.create_task(self.reload())
+
+    def signal_profile(self):
+        self.profiler.start()
+
+    def stop_logging(self):
+        # writes queued records and stops the writer thread, messages after stop are written directly
+        self.log_listener.stop()
+        self.logger.removeHandler(self.log_handler)
+        for handler in self.log_listener.handlers:
+            self.logger.addHandler(handler)
 
     def run(self):
+        try:
+            self._run()
+        finally:
+            self.stop_logging()
+
+    def _run(self):
         try:
             self.logger.info('Starting platforms')
             task = self.loop.create_task(self.start())
@@ -104,8 +191,11 @@ class Main:
 
         for signame in ('SIGINT', 'SIGTERM'):
             self.loop.add_signal_handler(getattr(signal, signame), self.signal_exit)
+        self.loop.add_signal_handler(signal.SIGHUP, self.signal_reload)
+        self.loop.add_signal_handler(signal.SIGUSR1, self.signal_profile)
 
         self.loop.run_forever()
+        self.profiler.cancel()
 
         try:
             self.logger.info('Stopping platforms')
@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 import asyncio
+import json
+import re
 
 import paho.mqtt.client as mqtt
 
+from megad.spool import Spool
+
 ############################################################################
 #             AsyncIO connector for MQTT protocol library                  #
 ############################################################################
@@ -19,6 +23,11 @@ MQTT_DEFAULT_PROTOCOL = MQTT_PROTOCOL_311
 
 MAX_RECONNECT_WAIT = 300  # seconds
 
+BATCH_VALUE_RE = re.compile(r'[0-9A-Za-z_]+')  # MegaD command value, separators of multi-command are not allowed
+
+MQTT_CONNECTION_KEYS = ('address', 'port', 'keepalive', 'client_id', 'protocol', 'username', 'password',
+                        'certificate', 'client_cert', 'client_key', 'tls_insecure')
+
 
 def _raise_on_error(result):
     if result != 0:
@@ -35,6 +44,7 @@ class MQTTConnector(object):
         self.keepalive = bool(config.get('keepalive', 'true'))
         self.async_on_connect_cb = async_on_connect
         self.async_on_message_cb = async_on_message
+        self.connected = False
         self._paho_lock = asyncio.Lock(loop=self.loop)
         self._mqttc = mqtt.Client(config.get('client_id', ''),
                                   protocol=mqtt.MQTTv31 if config.get('protocol', MQTT_PROTOCOL_311) == MQTT_PROTOCOL_31 else mqtt.MQTTv311)
@@ -86,10 +96,12 @@ class MQTTConnector(object):
             self._mqttc.disconnect()
             return
         self.logger.debug("Connected to MQTT.")
+        self.connected = True
         if self.async_on_connect_cb is not None:
             self.loop.call_soon_threadsafe(self._async_add_job, self.async_on_connect_cb)
 
     def _mqtt_on_disconnect(self, _mqttc, _userdata, result_code):
+        self.connected = False
         self.logger.debug("Disconnected from MQTT. Result code: {} ({}) ".format(mqtt.error_string(result_code), result_code))
 
     def _mqtt_on_message(self, _mqttc, _userdata, msg):
@@ -123,12 +135,19 @@ class Templates(object):
 
 class Device(object):
     class Port(object):
-        def __init__(self, port_description, mutable=(), constant=()):
-            self.port_description = port_description
+        # topics only, port descriptions with current values are taken from MegaD platform at publishing
+        def __init__(self, mutable=(), constant=()):
             self.mutable = mutable
             self.constant = constant
             self.subscribe = []
 
+        def topics(self):
+            return [t for t, _ in self.constant] + [t for t, _ in self.mutable]
+
+        def same_topics(self, other):
+            return self.mutable == other.mutable and self.constant == other.constant and \
+                list(self.subscribe) == list(other.subscribe)
+
     def _make_port_topics(self, topic_prefix, parameters, keywords):
         if topic_prefix is None:
             topic_prefix = parameters.get('port_topic')
@@ -165,94 +184,324 @@ class Device(object):
         self.name_topic = mqtt_templates.name_topic.format(device_id=device_id) if mqtt_templates.name_topic else None
         self.ports = {}
         for port_id, port_desc in ports.items():
-            template = mqtt_templates.find_port(port_desc)
-            if template is not None:
-                port_prefix, r_mutable, r_const = \
-                    self._make_port_topics(mqtt_templates.port_topic, template,
-                                           {'device_id': device_id, 'port_id': port_id, **port_desc})
-                if port_prefix is not None:
-                    cur_port = Device.Port(port_desc)
-                    cur_port.mutable = r_mutable
-                    cur_port.constant = r_const
-                    cur_port.subscribe = [port_prefix + '/on'] if r_mutable else ()
-                    self.ports[port_id] = cur_port
-            else:
-                if port_desc.get('type', '') != 'NC':
-                    self.logger.debug(f'No templates for port {port_id} on device {device_id} with description {port_desc}')
+            cur_port = self.make_port(port_id, port_desc, mqtt_templates)
+            if cur_port is not None:
+                self.ports[port_id] = cur_port
+
+    def make_port(self, port_id, port_desc, mqtt_templates):
+        template = mqtt_templates.find_port(port_desc)
+        if template is not None:
+            port_prefix, r_mutable, r_const = \
+                self._make_port_topics(mqtt_templates.port_topic, template,
+                                       {'device_id': self.device_id, 'port_id': port_id, **port_desc})
+            if port_prefix is not None:
+                cur_port = Device.Port()
+                cur_port.mutable = r_mutable
+                cur_port.constant = r_const
+                cur_port.subscribe = [port_prefix + '/on'] if r_mutable else ()
+                return cur_port
+        else:
+            if port_desc.get('type', '') != 'NC':
+                self.logger.debug('No templates for port %s on device %s with description %s', port_id, self.device_id, port_desc)
+        return None
 
 
-class Platform(object):
-    def __init__(self, loop, logger, config, on_state_changed):
+class Profile(object):
+    def __init__(self, loop, logger, name, config, on_state_changed, get_ports, on_batch=None, connector=MQTTConnector):
         self.loop = loop
         self.logger = logger
 
+        self.name = name
+        self.config = config
         self.subscribe_topic_to_device_port = {}
         self.notify_topic = config.get('notify_topic', None)
+        self.batch_topic = config.get('batch_topic', None)
         self.templates = Templates(config.get('name_topic'), config.get('port_topic'), config.get('templates', {}))
         self.devices = {}
-        self.client = MQTTConnector(loop, logger, config, self.on_mqtt_connect, self.on_mqtt_message)
+        self.client = connector(loop, logger, config, self.on_mqtt_connect, self.on_mqtt_message)
+        self.spool = Spool(loop, logger, config['spool'], self.client.async_publish, lambda: self.client.connected) \
+            if 'spool' in config else None
 
         self.on_state_changed = on_state_changed
+        self.get_ports = get_ports
+        self.on_batch = on_batch
+        self.recorder = None  # set by platform to capture inbound messages
 
     async def start(self):
         await self.client.start()
 
     async def stop(self):
         await self.client.stop()
+        if self.spool is not None:
+            self.spool.close()
+
+    async def _publish(self, topic, payload, qos, retain):
+        # while broker is unreachable or spooled messages are not flushed yet, keep order through spool
+        if self.spool is not None and (not self.client.connected or self.spool.pending):
+            self.spool.put(topic, payload, qos, retain)
+            if self.client.connected:
+                self.spool.flush()
+        else:
+            await self.client.async_publish(topic, payload, qos, retain)
 
     async def on_mqtt_connect(self):
-        for dev_id, dev in self.devices.items():
+        if self.spool is not None:
+            self.spool.flush()
+        if self.batch_topic:
+            await self.client.async_subscribe(self.batch_topic)
+        for dev_id in list(self.devices):
             await self.publish_device(dev_id, None)
 
+    async def reload(self, config):
+        if any(self.config.get(k) != config.get(k) for k in MQTT_CONNECTION_KEYS):
+            self.logger.warning(f'MQTT connection parameters of profile "{self.name}" changed. Restart required to apply them')
+        self.config = config
+        self.notify_topic = config.get('notify_topic', None)
+        self.templates = Templates(config.get('name_topic'), config.get('port_topic'), config.get('templates', {}))
+        if config.get('batch_topic') != self.batch_topic:
+            if self.batch_topic:
+                await self.client.async_unsubscribe(self.batch_topic)
+            self.batch_topic = config.get('batch_topic')
+            if self.batch_topic:
+                await self.client.async_subscribe(self.batch_topic)
+
+        for device_id, cur_dev in list(self.devices.items()):
+            name_topic = self.templates.name_topic.format(device_id=device_id) if self.templates.name_topic else None
+            if name_topic != cur_dev.name_topic:
+                if cur_dev.name_topic:
+                    await self._publish(cur_dev.name_topic, '', 0, True)
+                cur_dev.name_topic = name_topic
+                if cur_dev.name_topic:
+                    await self._publish(cur_dev.name_topic, cur_dev.device_id, 0, True)
+
+            # templates are applied to the current port values
+            ports = self.get_ports(device_id)
+            for port_id, port_desc in ports.items():
+                old_port = cur_dev.ports.get(port_id)
+                new_port = cur_dev.make_port(port_id, port_desc, self.templates)
+                if old_port is None and new_port is None:
+                    continue
+                if old_port is not None and new_port is not None and old_port.same_topics(new_port):
+                    continue
+                self.logger.info(f'MQTT topics of port {port_id} on device {device_id} changed')
+                if old_port is not None:
+                    if new_port is not None:
+                        await self._unpublish_port(old_port, new_port.topics(), new_port.subscribe)
+                    else:
+                        await self._unpublish_port(old_port)
+                    del cur_dev.ports[port_id]
+                if new_port is not None:
+                    cur_dev.ports[port_id] = new_port
+                    await self._publish_port(device_id, port_id, new_port, port_desc)
+
+    async def remove_device(self, device_id):
+        cur_dev = self.devices.pop(device_id, None)
+        if cur_dev is None:
+            return
+        self.logger.debug('MQTT remove device %s', device_id)
+        if cur_dev.name_topic:
+            await self._publish(cur_dev.name_topic, '', 0, True)
+        for cur_port in cur_dev.ports.values():
+            await self._unpublish_port(cur_port)
+
+    @staticmethod
+    def _batch_value(value):
+        # JSON value to MegaD command value: true -> 1, 128.0 -> 128, "2" -> 2
+        if isinstance(value, bool):
+            return '1' if value else '0'
+        if isinstance(value, int):
+            return str(value)
+        if isinstance(value, float) and value.is_integer():
+            return str(int(value))
+        if isinstance(value, str) and BATCH_VALUE_RE.fullmatch(value):
+            return value
+        return None
+
+    def _parse_batch(self, payload):
+        # [["megad_192_168_1_114", "p7", 1], {"device": "megad_192_168_1_114", "port": "p8", "value": 0}, ...]
+        commands = []
+        for entry in json.loads(payload.decode('utf-8')):
+            if isinstance(entry, dict):
+                entry = (entry.get('device'), entry.get('port'), entry.get('value'))
+            if not isinstance(entry, (list, tuple)) or len(entry) != 3 or \
+                    not isinstance(entry[0], str) or not isinstance(entry[1], str):
+                self.logger.warning(f'MQTT batch entry {entry} skipped. Must be (device, port, value)')
+                continue
+            value = self._batch_value(entry[2])
+            if value is None:
+                self.logger.warning(f'MQTT batch entry {entry} skipped. Incorrect value')
+                continue
+            commands.append((entry[0], entry[1], value))
+        return commands
+
     async def on_mqtt_message(self, topic, payload):
+        if self.recorder is not None:
+            self.recorder.mqtt(self.name, topic, payload)
         try:
-            if topic in self.subscribe_topic_to_device_port:
+            if self.batch_topic and topic == self.batch_topic:
+                commands = self._parse_batch(payload)
+                self.logger.debug('MQTT inbound batch with %d commands', len(commands))
+                if self.on_batch and commands:
+                    await self.on_batch(commands)
+            elif topic in self.subscribe_topic_to_device_port:
                 device_id, port_id = self.subscribe_topic_to_device_port[topic]
-                self.logger.debug(f'MQTT inbound message for {device_id} with parameters {port_id} and payload {payload.decode("utf-8")}')
+                value = payload.decode('utf-8')
+                self.logger.debug('MQTT inbound message for %s with parameters %s and payload %s', device_id, port_id, value)
                 if self.on_state_changed:
-                    await self.on_state_changed(device_id, port_id, payload.decode('utf-8'))
+                    await self.on_state_changed(device_id, port_id, value)
         except Exception as e:
             self.logger.exception(f'Exception on MQTT message processing. Exception type: {type(e)} message: {e}')
 
+    def add_device(self, device_id, ports):
+        cur_dev = Device(self.loop, self.logger, device_id, ports, self.templates)
+        self.devices[device_id] = cur_dev
+        return cur_dev
+
     async def publish_device(self, device_id, ports):
         if ports is None:
             cur_dev = self.devices[device_id]
+            ports = self.get_ports(device_id)
         else:
-            cur_dev = Device(self.loop, self.logger, device_id, ports, self.templates)
-            self.devices[device_id] = cur_dev
+            cur_dev = self.add_device(device_id, ports)
 
-        self.logger.debug(f'MQTT publish device {device_id}')
+        self.logger.debug('MQTT publish device %s', device_id)
 
         if cur_dev.name_topic:
-            await self.client.async_publish(cur_dev.name_topic, cur_dev.device_id, 0, True)
-        for port_id, cur_port in cur_dev.ports.items():
-            v_keyword = {'device_id': device_id, 'port_id': port_id, **cur_port.port_description}
-            self.logger.debug(f'    Port {port_id}, {cur_port.port_description}')
-            for t, v in cur_port.constant:
-                try:
-                    v_parsed = v.format(port_topic=t, **v_keyword) if type(v) is str else str(v)
-                    await self.client.async_publish(t, v_parsed, 0, True)
-                    self.logger.debug(f'        publish as constant {t}: {v_parsed}')
-                except KeyError as e:
-                    self.logger.warning(f'         publish as constant {t} has unknown key {e} in value template {v}')
-            for t, v in cur_port.mutable:
-                try:
-                    v_parsed = v.format(port_topic=t, **v_keyword) if type(v) is str else str(v)
-                    await self.client.async_publish(t, v_parsed, 0, True)
-                    self.logger.debug(f'        publish as mutable  {t}: {v_parsed}')
-                except KeyError as e:
-                    self.logger.warning(f'         publish as mutable  {t} has unknown key {e} in value template {v}')
-            for t in cur_port.subscribe:
-                await self.client.async_subscribe(t)
-                self.subscribe_topic_to_device_port[t] = (device_id, port_id)
-                self.logger.debug(f'        subscribe on {t}')
+            await self._publish(cur_dev.name_topic, cur_dev.device_id, 0, True)
+        for port_id, cur_port in list(cur_dev.ports.items()):
+            await self._publish_port(device_id, port_id, cur_port, ports.get(port_id, {}))
+
+    async def _publish_port(self, device_id, port_id, cur_port, port_desc):
+        v_keyword = {'device_id': device_id, 'port_id': port_id, **port_desc}
+        self.logger.debug('    Port %s, %s', port_id, port_desc)
+        for t, v in cur_port.constant:
+            try:
+                v_parsed = v.format(port_topic=t, **v_keyword) if type(v) is str else str(v)
+                await self._publish(t, v_parsed, 0, True)
+                self.logger.debug('        publish as constant %s: %s', t, v_parsed)
+            except KeyError as e:
+                self.logger.warning(f'         publish as constant {t} has unknown key {e} in value template {v}')
+        for t, v in cur_port.mutable:
+            try:
+                v_parsed = v.format(port_topic=t, **v_keyword) if type(v) is str else str(v)
+                await self._publish(t, v_parsed, 0, True)
+                self.logger.debug('        publish as mutable  %s: %s', t, v_parsed)
+            except KeyError as e:
+                self.logger.warning(f'         publish as mutable  {t} has unknown key {e} in value template {v}')
+        for t in cur_port.subscribe:
+            await self.client.async_subscribe(t)
+            self.subscribe_topic_to_device_port[t] = (device_id, port_id)
+            self.logger.debug('        subscribe on %s', t)
+
+    async def _unpublish_port(self, cur_port, keep_topics=(), keep_subscribe=()):
+        # clear retained topics which are not republished, keep subscriptions which are made again
+        for t in cur_port.topics():
+            if t not in keep_topics:
+                await self._publish(t, '', 0, True)
+                self.logger.debug('        clear %s', t)
+        for t in cur_port.subscribe:
+            if t in keep_subscribe:
+                continue
+            await self.client.async_unsubscribe(t)
+            self.subscribe_topic_to_device_port.pop(t, None)
+            self.logger.debug('        unsubscribe from %s', t)
 
     async def send_message(self, device_id, port, value):
         v_keyword = {'device_id': device_id, 'port': port, 'value': value}
         if device_id in self.devices and port in self.devices[device_id].ports:
-            for t, v in self.devices[device_id].ports[port].mutable:
+            cur_port = self.devices[device_id].ports[port]
+            for t, v in cur_port.mutable:
                 v_parsed = v.format(**v_keyword)
-                self.logger.debug(f'MQTT outbound message for topic {t} => {v_parsed}')
-                await self.client.async_publish(t, v_parsed, 0, True)
+                self.logger.debug('MQTT outbound message for topic %s => %s', t, v_parsed)
+                await self._publish(t, v_parsed, 0, True)
         else:
-            self.logger.debug(f'MQTT skip outbound message. No port {port} at device {device_id}')
+            self.logger.debug('MQTT skip outbound message. No port %s at device %s', port, device_id)
+
+
+class Platform(object):
+    def __init__(self, loop, logger, config, on_state_changed, get_ports, on_batch=None, connector=MQTTConnector):
+        self.loop = loop
+        self.logger = logger
+        self.connector = connector
+
+        self.device_ids = set()  # published devices, their ports are taken by get_ports
+        self.on_state_changed = on_state_changed
+        self.get_ports = get_ports  # returns ports descriptions of device with current values
+        self.on_batch = on_batch
+        self.recorder = None
+        self.profiles = {name: Profile(loop, logger, name, cf, self.on_profile_message, get_ports,
+                                       self.on_profile_batch, connector)
+                         for name, cf in self._profiles_config(config).items()}
+
+    def _profiles_config(self, config):
+        # every profile is a separate broker with own templates, common settings are inherited from mqtt section
+        profiles = config.get('profiles')
+        if not profiles:
+            return {'default': config}
+        common = {k: v for k, v in config.items() if k != 'profiles'}
+        result = {}
+        for idx, profile in enumerate(profiles):
+            cf = {**common, **profile}
+            name = str(cf.get('name', idx))
+            if 'spool' in cf and 'spool' not in profile:
+                cf['spool'] = {**cf['spool'], 'path': f'{cf["spool"]["path"]}.{name}'}
+            result[name] = cf
+        return result
+
+    async def _for_profiles(self, action, *args):
+        # one broker failure should not affect others
+        profiles = list(self.profiles.values())
+        results = await asyncio.gather(*[getattr(profile, action)(*args) for profile in profiles], return_exceptions=True)
+        for profile, result in zip(profiles, results):
+            if isinstance(result, Exception):
+                self.logger.error(f'Error at {action} for MQTT profile "{profile.name}". Exception type: {type(result)} '
+                                  f'message: {result}')
+
+    def set_recorder(self, recorder):
+        self.recorder = recorder
+        for profile in self.profiles.values():
+            profile.recorder = recorder
+
+    async def start(self):
+        await asyncio.gather(*[profile.start() for profile in self.profiles.values()])
+
+    async def stop(self):
+        await self._for_profiles('stop')
+
+    async def reload(self, config):
+        profiles_config = self._profiles_config(config)
+        for name in list(self.profiles):
+            if name not in profiles_config:
+                self.logger.info(f'MQTT profile "{name}" removed')
+                await self.profiles.pop(name).stop()
+        for name, cf in profiles_config.items():
+            if name in self.profiles:
+                await self.profiles[name].reload(cf)
+            else:
+                self.logger.info(f'MQTT profile "{name}" added')
+                profile = Profile(self.loop, self.logger, name, cf, self.on_profile_message, self.get_ports,
+                                  self.on_profile_batch, self.connector)
+                profile.recorder = self.recorder
+                for device_id in self.device_ids:
+                    profile.add_device(device_id, self.get_ports(device_id))  # published on connect
+                self.profiles[name] = profile
+                await profile.start()
+
+    async def on_profile_message(self, device_id, port_id, value):
+        if self.on_state_changed:
+            await self.on_state_changed(device_id, port_id, value)
+
+    async def on_profile_batch(self, commands):
+        if self.on_batch:
+            await self.on_batch(commands)
+
+    async def publish_device(self, device_id, ports):
+        self.device_ids.add(device_id)
+        await self._for_profiles('publish_device', device_id, ports)
+
+    async def remove_device(self, device_id):
+        self.device_ids.discard(device_id)
+        await self._for_profiles('remove_device', device_id)
+
+    async def send_message(self, device_id, port, value):
+        await self._for_profiles('send_message', device_id, port, value)
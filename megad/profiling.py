@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+import cProfile
+import io
+import os
+import pstats
+import time
+
+############################################################################
+#         On-demand time-limited profiling of the running gateway          #
+############################################################################
+
+
+PROFILE_DEFAULT_PATH = '/var/log/megad-mqtt-gw.profile'
+PROFILE_DEFAULT_DURATION = 30  # seconds
+PROFILE_MAX_DURATION = 600  # seconds
+PROFILE_TOP = 15  # functions per stage in the report
+
+# functions opening the stage, callees are attributed to the nearest stage up the call graph
+STAGES = {
+    ('megad.py', 'discovery'): 'discovery',
+    ('megad.py', 'datagram_received'): 'discovery',
+    ('megad.py', 'check_disabled'): 'discovery',
+    ('megad.py', 'enable_devices'): 'discovery',
+    ('megad.py', 'query_device'): 'crawl',
+    ('megad.py', '_query_expanders'): 'crawl',
+    ('megad.py', '_parse_port_html'): 'crawl',
+    ('megad.py', 'check_config'): 'crawl',
+    ('megad.py', 'pool'): 'poll',
+    ('megad.py', 'parse_message'): 'parse',
+    ('megad.py', '_parse_port_value'): 'parse',
+    ('megad.py', '_parse_ext_value'): 'parse',
+    ('mqtt.py', 'publish_device'): 'publish',
+    ('mqtt.py', 'remove_device'): 'publish',
+    ('mqtt.py', 'send_message'): 'publish',
+    ('mqtt.py', '_publish'): 'publish',
+    ('mqtt.py', 'flush'): 'publish',
+    ('megad.py', 'handler'): 'callback',
+    ('megad.py', 'send_message'): 'callback',
+    ('megad.py', 'send_batch'): 'callback',
+    ('mqtt.py', '_mqtt_on_message'): 'callback',
+    ('mqtt.py', 'on_mqtt_message'): 'callback',
+    ('selectors.py', 'select'): 'idle',
+}
+STAGES_ORDER = ('discovery', 'crawl', 'poll', 'parse', 'publish', 'callback', 'idle', 'other')
+
+
+def _stage_times(stats):
+    # own time of every function is split between stages in proportion to the time of its callers
+    shares = {}
+
+    def stage_shares(func):
+        if func in shares:
+            return shares[func]
+        filename, _, name = func
+        stage = STAGES.get((os.path.basename(filename), name))
+        if stage is not None:
+            shares[func] = {stage: 1.0}
+            return shares[func]
+        shares[func] = {}  # breaks recursion cycles
+        result = {}
+        callers = stats[func][4]
+        for caller, caller_stats in callers.items():
+            weight = caller_stats[3] if isinstance(caller_stats, tuple) else caller_stats
+            if caller not in stats or weight <= 0:
+                continue
+            for caller_stage, share in stage_shares(caller).items():
+                result[caller_stage] = result.get(caller_stage, 0) + weight * share
+        total = sum(result.values())
+        shares[func] = {stage: share / total for stage, share in result.items()} if total > 0 else {'other': 1.0}
+        return shares[func]
+
+    stages = {stage: {} for stage in STAGES_ORDER}
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        for stage, share in stage_shares(func).items():
+            stages[stage][func] = (nc, tt * share)
+    return stages
+
+
+def _function_name(func):
+    filename, line, name = func
+    return f'{name} ({os.path.basename(filename)}:{line})' if line else name
+
+
+class Profiler(object):
+    def __init__(self, loop, logger, config):
+        self.loop = loop
+        self.logger = logger
+        self.path = config.get('path', PROFILE_DEFAULT_PATH)
+        self.duration = float(config.get('duration', PROFILE_DEFAULT_DURATION))
+        self.max_duration = float(config.get('max_duration', PROFILE_MAX_DURATION))
+        self.profile = None
+        self.started = None
+        self._stop_handle = None
+
+    @property
+    def running(self):
+        return self.profile is not None
+
+    def start(self, duration=None):
+        # returns name of the report file, or None if profiling is already running
+        if self.running:
+            self.logger.warning('Profiling is already running')
+            return None
+        duration = min(float(duration or self.duration), self.max_duration)
+        report_path = self.path + time.strftime('.%Y%m%d-%H%M%S')
+        self.logger.info(f'Profiling started for {duration} seconds. Report will be written to {report_path}')
+        self.started = time.time()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        self._stop_handle = self.loop.call_later(duration, self.stop, report_path)
+        return report_path
+
+    def stop(self, report_path):
+        # returns future of report writing
+        if not self.running:
+            return None
+        if self._stop_handle is not None:
+            self._stop_handle.cancel()
+        self.profile.disable()
+        profile, started = self.profile, self.started
+        self.profile, self._stop_handle = None, None
+        return self.loop.run_in_executor(None, self._write_report, profile, started, report_path)
+
+    def cancel(self):
+        if self._stop_handle is not None:
+            self._stop_handle.cancel()
+        if self.running:
+            self.profile.disable()
+            self.profile, self._stop_handle = None, None
+
+    def _write_report(self, profile, started, report_path):
+        try:
+            stream = io.StringIO()
+            stats = pstats.Stats(profile, stream=stream)
+            stages = _stage_times(stats.stats)
+            totals = {stage: sum(tt for nc, tt in funcs.values()) for stage, funcs in stages.items()}
+            total = sum(totals.values()) or 1
+
+            stream.write(f'Profiling started {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(started))}, '
+                         f'duration {time.time() - started:.1f} s, profiled time {total:.3f} s\n\n')
+            stream.write(f'{"stage":<12}{"time, s":>12}{"share":>9}\n')
+            for stage in STAGES_ORDER:
+                stream.write(f'{stage:<12}{totals[stage]:>12.3f}{totals[stage] / total:>9.1%}\n')
+            for stage in STAGES_ORDER:
+                if not stages[stage]:
+                    continue
+                stream.write(f'\nStage {stage}, own time of functions and coroutine steps:\n')
+                stream.write(f'{"ncalls":>10}{"time, s":>12}  function\n')
+                top = sorted(stages[stage].items(), key=lambda item: item[1][1], reverse=True)[:PROFILE_TOP]
+                for func, (nc, tt) in top:
+                    stream.write(f'{nc:>10}{tt:>12.6f}  {_function_name(func)}\n')
+            stream.write('\nAll functions:\n')
+            stats.sort_stats('cumulative').print_stats(PROFILE_TOP * 4)
+
+            with open(report_path, 'wt', encoding='utf-8') as f:
+                f.write(stream.getvalue())
+            stats.dump_stats(report_path + '.pstats')
+            self.logger.info(f'Profiling report written to {report_path}')
+        except Exception as e:
+            self.logger.exception(f'Error at writing profiling report. Exception type: {type(e)} message: {e}')
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+import gzip
+import json
+import time
+import zlib
+
+############################################################################
+#     Capture of MegaD responses, callbacks and MQTT commands for replay   #
+############################################################################
+
+
+CAPTURE_FORMAT = 'megad-mqtt-gw-capture'
+CAPTURE_VERSION = 1
+
+# events are JSON lines [time offset, kind, ...] after the header line
+EVENT_FETCH = 'f'  # url, response body or null on failure, request duration
+EVENT_CALLBACK = 'c'  # address of MegaD, query string
+EVENT_MQTT = 'm'  # profile name, topic, payload
+
+
+class Recorder(object):
+    def __init__(self, logger, path):
+        self.logger = logger
+        self.path = path
+        self.events = 0
+        self.started = time.monotonic()
+        self._file = gzip.open(path, 'wt', encoding='utf-8')
+        self._write({'format': CAPTURE_FORMAT, 'version': CAPTURE_VERSION, 'started': time.time()})
+        self.logger.info(f'Recording device responses, callbacks and MQTT commands to {path}')
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+    def _event(self, timestamp, kind, *args):
+        if self._file is None:
+            return
+        self.events += 1
+        self._write([round(timestamp - self.started, 3), kind, *args])
+
+    def fetch(self, url, body, started):
+        # timestamp is the start of request, so replay answers with the state device had at that moment
+        self._event(started, EVENT_FETCH, url, body, round(time.monotonic() - started, 3))
+
+    def callback(self, address, query_string):
+        self._event(time.monotonic(), EVENT_CALLBACK, address, query_string)
+
+    def mqtt(self, profile, topic, payload):
+        # payloads are bytes, undecodable ones are kept as escaped surrogates
+        self._event(time.monotonic(), EVENT_MQTT, profile, topic, payload.decode('utf-8', 'surrogateescape'))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self.logger.info(f'Recording finished. {self.events} events written to {self.path}')
+
+
+def load(logger, path):
+    # returns header and events, the tail of recording interrupted without close is skipped
+    events = []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        header = json.loads(f.readline() or '{}')
+        if header.get('format') != CAPTURE_FORMAT or header.get('version') != CAPTURE_VERSION:
+            raise ValueError(f'File "{path}" is not a capture of version {CAPTURE_VERSION}')
+        try:
+            for line in f:
+                events.append(json.loads(line))
+        except (EOFError, zlib.error, ValueError) as e:
+            logger.warning(f'Capture "{path}" is incomplete, {len(events)} events loaded. '
+                           f'Exception type: {type(e)} message: {e}')
+    for event in events:
+        if event[1] == EVENT_MQTT:
+            event[4] = event[4].encode('utf-8', 'surrogateescape')
+    return header, events
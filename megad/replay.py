@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+from bisect import bisect_right
+from collections import Counter
+
+import aiohttp
+import yarl
+
+import megad.megad
+import megad.profiling
+import megad.recorder
+from megad.gateway import Gateway
+from megad.loopback import LoopbackConnector, cancel_tasks
+
+############################################################################
+#     Replay of captured MegaD responses, callbacks and MQTT commands      #
+############################################################################
+
+
+class ReplayDevice(megad.megad.Device):
+    # answers requests with recorded responses instead of the network
+    player = None
+
+    async def _fetch(self, url):
+        return await self.player.response(url)
+
+
+class Player(object):
+    def __init__(self, loop, logger, config, events, speed):
+        self.loop = loop
+        self.logger = logger
+        self.speed = speed
+        self.started = None
+        self.tasks = set()
+        self.unmatched = Counter()  # urls requested by gateway but absent in capture
+        self.served = 0
+
+        fetches = {}
+        self.events = []  # callbacks and MQTT commands
+        for event in events:
+            if event[1] == megad.recorder.EVENT_FETCH:
+                fetches.setdefault(event[2], []).append((event[0], event[3], event[4]))
+            else:
+                self.events.append(event)
+        # url -> (request times, (response body, request duration)), fetches are written on completion, so sorted here
+        self.responses = {}
+        for url, url_fetches in fetches.items():
+            url_fetches.sort(key=lambda fetch: fetch[0])
+            self.responses[url] = ([t for t, _, _ in url_fetches], [(body, dur) for _, body, dur in url_fetches])
+
+        # devices are taken from capture, the rest of configuration is used as is
+        devices = sorted({tuple(url.split('/', 4)[2:4]) for url in self.responses})
+        megad_config = dict(config.get('megad', {}))
+        megad_config['devices'] = [{'address': address, 'password': password} for address, password in devices]
+        megad_config['scan'] = {'enabled': ''}
+        megad_config['server'] = {'address': '127.0.0.1', 'port': 0}
+        megad_config['pool'] = float(megad_config.get('pool', 0)) / speed
+        megad_config['pool_state'] = float(megad_config.get('pool_state', 0.1)) / speed
+        # spool files of the production gateway should not be touched
+        mqtt_config = {k: v for k, v in config.get('mqtt', {}).items() if k != 'spool'}
+        if 'profiles' in mqtt_config:
+            mqtt_config['profiles'] = [{k: v for k, v in profile.items() if k != 'spool'}
+                                       for profile in mqtt_config['profiles']]
+
+        device_class = type('ReplayDevice', (ReplayDevice,), {'player': self})
+        self.gateway = Gateway(loop, logger, {'megad': megad_config, 'mqtt': mqtt_config}, LoopbackConnector, device_class)
+        self.logger.info(f'Capture has {len(devices)} devices, {len(events) - len(self.events)} responses, '
+                         f'{len(self.events)} callbacks and MQTT commands')
+
+    def now(self):
+        # time offset in capture
+        return (self.loop.time() - self.started) * self.speed
+
+    async def response(self, url):
+        # the latest response recorded before the current moment of capture, or the first one
+        if url not in self.responses:
+            self.unmatched[url] += 1
+            return ''
+        times, bodies = self.responses[url]
+        body, duration = bodies[max(bisect_right(times, self.now()) - 1, 0)]
+        self.served += 1
+        await asyncio.sleep(duration / self.speed)
+        if body is None:
+            raise aiohttp.ClientConnectionError(f'Request {url} failed at capture')
+        return body
+
+    def _dispatch(self, event):
+        if event[1] == megad.recorder.EVENT_CALLBACK:
+            _, _, address, query_string = event
+            coro = self.gateway.megad.devices.parse_message(address, yarl.URL.build(query_string=query_string).query)
+        elif event[1] == megad.recorder.EVENT_MQTT:
+            _, _, name, topic, payload = event
+            profiles = self.gateway.mqtt.profiles
+            profile = profiles.get(name) or next(iter(profiles.values()))
+            coro = profile.on_mqtt_message(topic, payload)
+        else:
+            self.logger.warning(f'Unknown capture event {event[1]} skipped')
+            return
+        # handled concurrently as incoming HTTP requests and MQTT messages are
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self, duration):
+        self.started = self.loop.time()
+        await self.gateway.start()
+        try:
+            for event in self.events:
+                delay = event[0] / self.speed - (self.loop.time() - self.started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self._dispatch(event)
+            await asyncio.sleep(duration / self.speed - (self.loop.time() - self.started))
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        finally:
+            await self.gateway.stop()
+            await cancel_tasks(self.loop)
+
+    def report(self):
+        published = sum(profile.client.published for profile in self.gateway.mqtt.profiles.values())
+        self.logger.info(f'Replayed in {self.loop.time() - self.started:.1f} s: {self.served} responses served, '
+                         f'{len(self.events)} callbacks and MQTT commands, {published} MQTT messages published')
+        if self.unmatched:
+            self.logger.warning(f'{sum(self.unmatched.values())} requests absent in capture, most frequent:\n' +
+                                '\n'.join(f'{count:>8}  {url}' for url, count in self.unmatched.most_common(10)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay of MegaD-MQTT gateway capture without hardware and broker.')
+    parser.add_argument('capture', help='file written by megad-mqtt-gw --record')
+    parser.add_argument('--config', default='/etc/megad-mqtt-gw.conf', help='name of configuration file')
+    parser.add_argument('--speed', type=float, default=1, help='replay speed, 1 is real time')
+    parser.add_argument('--profile', default=None, help='profile the replay, report is written to <path>.<date-time>')
+    parser.add_argument('--debug', action='store_true', default=False, help='output gateway debug messages')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
+
+    try:
+        config = json.load(open(args.config, 'rt', encoding='utf-8'))
+        header, events = megad.recorder.load(logger, args.capture)
+    except Exception as e:
+        logger.error(f'Can\'t load replay data. Exception type: {type(e)} message: {e}')
+        sys.exit(1)
+    duration = max((event[0] for event in events), default=0)
+    logger.info(f'Capture started {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(header["started"]))}, '
+                f'duration {duration:.1f} s, replay speed {args.speed}')
+
+    loop = asyncio.get_event_loop()
+    player = Player(loop, logger, config, events, args.speed)
+    profiler, report_path = None, None
+    if args.profile:
+        limit = duration / args.speed + 60  # stopped when replay ends
+        profiler = megad.profiling.Profiler(loop, logger, {'path': args.profile, 'duration': limit, 'max_duration': limit})
+        report_path = profiler.start()
+    try:
+        loop.run_until_complete(player.run(duration))
+    finally:
+        if profiler is not None:
+            # report is already written if profiling stopped by its time limit
+            report = profiler.stop(report_path)
+            if report is not None:
+                loop.run_until_complete(report)
+        player.report()
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
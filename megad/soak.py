@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import random
+import sys
+import time
+import tracemalloc
+
+import aiohttp
+import aiohttp.web
+
+from megad.gateway import Gateway
+from megad.loopback import LoopbackConnector, cancel_tasks
+
+############################################################################
+#    Soak test: gateway against local MegaD and MQTT stand-ins for days    #
+############################################################################
+
+
+SOAK_PASSWORD = 'sec'
+SOAK_TOPIC_PREFIX = 'soak'
+SOAK_BATCH_TOPIC = 'soak/batch'
+
+# port number -> (type name, port page attributes)
+SOAK_PORTS = {
+    **{pn: ('IN', {'pty': 0}) for pn in range(0, 8)},
+    **{pn: ('OUT', {'pty': 1, 'm': 0}) for pn in range(8, 16)},
+    **{pn: ('OUT', {'pty': 1, 'm': 1}) for pn in range(16, 20)},
+    **{pn: ('ADC', {'pty': 2}) for pn in range(20, 24)},
+    30: ('I2C', {'pty': 4, 'm': 1, 'd': 20}),
+    31: ('I2C', {'pty': 4, 'm': 2}),
+}
+SOAK_PORTS_COUNT = 38
+SOAK_EXT_CHANNELS = 16
+
+SOAK_TEMPLATES = {
+    'pty=0': {'state': '{value}'},
+    'pty=1&m=0': {'state': '{value}', 'config': '{{ "name": "{device_id} {port_id}" }}'},
+    'pty=1&m=1': {'state': '{value}', 'config': '{{ "name": "{device_id} {port_id}" }}'},
+    'pty=2': {'state': '{value}'},
+    'type=EXT&d=20': {'state': '{value}', 'config': '{{ "name": "{device_id} {port_id}" }}'},
+}
+
+
+class FakeMegaD(object):
+    # HTTP stand-in of MegaD-2561 with randomly changing port values
+    def __init__(self, loop, host, port, gateway_address):
+        self.loop = loop
+        self.host = host
+        self.port = port
+        self.mdid = host.replace('.', '_')
+        self.gateway_address = gateway_address
+        self.values = {pn: self._initial(pn) for pn in range(SOAK_PORTS_COUNT)}
+        self.ext_values = ['OFF'] * SOAK_EXT_CHANNELS
+        self.runner = None
+        self.session = None
+        self.requests = 0
+
+    def _initial(self, pn):
+        kind, attrs = SOAK_PORTS.get(pn, ('NC', {}))
+        if kind == 'IN' or (kind == 'OUT' and attrs['m'] == 0):
+            return 'OFF'
+        if kind in ('OUT', 'ADC'):
+            return '0'
+        return ''
+
+    def _mutate(self):
+        pn = random.choice(list(SOAK_PORTS))
+        kind, attrs = SOAK_PORTS[pn]
+        if kind == 'IN' or (kind == 'OUT' and attrs['m'] == 0):
+            self.values[pn] = 'ON' if self.values[pn] == 'OFF' else 'OFF'
+        elif kind in ('OUT', 'ADC'):
+            self.values[pn] = str(random.randint(0, 255))
+        self.ext_values[random.randrange(SOAK_EXT_CHANNELS)] = random.choice(('ON', 'OFF'))
+
+    def _port_page(self, pn):
+        kind, attrs = SOAK_PORTS.get(pn, ('NC', {'pty': 255}))
+        html = f'<input name=pn value={pn}>'
+        for name, value in attrs.items():
+            html += f'<select name={name}><option value={value} selected>{value}</option></select>'
+        return html
+
+    def _command(self, cmd):
+        for item in cmd.split(';'):
+            control, _, value = item.partition(':')
+            if 'e' in control:
+                pn, ext = control.split('e')
+                self.ext_values[int(ext) % SOAK_EXT_CHANNELS] = 'ON' if value == '1' else 'OFF'
+            elif control.isdigit() and int(control) in self.values:
+                kind, attrs = SOAK_PORTS.get(int(control), ('NC', {}))
+                if kind == 'OUT' and attrs['m'] == 0:
+                    self.values[int(control)] = 'ON' if value == '1' else 'OFF'
+                elif kind == 'OUT':
+                    self.values[int(control)] = value
+        return 'Done'
+
+    async def handler(self, request):
+        self.requests += 1
+        query = request.rel_url.query
+        if 'cf' in query:
+            if query['cf'] == '2':
+                text = f'<input name=mdid size=5 value="{self.mdid}">'
+            elif query['cf'] == '1':
+                text = f'<input name=sip value={self.gateway_address}><input name=sct value="megad">'
+            else:
+                text = ''
+        elif 'cmd' in query and 'pt' in query:
+            text = ';'.join(self.ext_values) if query['cmd'] == 'get' else ''
+        elif 'cmd' in query:
+            if query['cmd'] == 'all':
+                self._mutate()
+                text = ';'.join(self.values[pn] for pn in range(SOAK_PORTS_COUNT))
+            else:
+                text = self._command(query['cmd'])
+        elif 'pt' in query:
+            text = self._port_page(int(query['pt']))
+        else:
+            text = 'MegaD-2561' + ''.join(f'<a href=/{SOAK_PASSWORD}/?pt={pn}>P{pn} - {SOAK_PORTS.get(pn, ("NC",))[0]}</a>'
+                                          for pn in range(SOAK_PORTS_COUNT))
+        return aiohttp.web.Response(text=text)
+
+    async def start(self):
+        app = aiohttp.web.Application()
+        app.router.add_route('GET', '/{tail:.*}', self.handler)
+        self.runner = aiohttp.web.AppRunner(app)
+        await self.runner.setup()
+        await aiohttp.web.TCPSite(self.runner, self.host, self.port).start()
+        # callbacks must come from the address of device
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(local_addr=(self.host, 0)))
+
+    async def stop(self):
+        await self.session.close()
+        await self.runner.cleanup()
+
+    async def send_callback(self):
+        pn = random.randrange(8)
+        url = f'http://{self.gateway_address}/megad?pt={pn}&m={random.randint(0, 2)}'
+        async with self.session.get(url) as resp:
+            await resp.read()
+
+
+class Soak(object):
+    def __init__(self, loop, logger, args):
+        self.loop = loop
+        self.logger = logger
+        self.args = args
+        self.duration = args.days * 86400 / args.speed  # real seconds
+        gateway_address = f'127.0.0.1:{args.port}'
+        self.fakes = [FakeMegaD(loop, f'127.0.0.{idx + 2}', args.port + idx + 1, gateway_address)
+                      for idx in range(args.devices)]
+        config = {
+            'megad': {
+                'server': {'address': '127.0.0.1', 'port': args.port},
+                'devices': [{'address': f'{fake.host}:{fake.port}', 'password': SOAK_PASSWORD} for fake in self.fakes],
+                'scan': {'enabled': ''},
+                'pool': 20 / args.speed,
+                'pool_state': 0.1,
+            },
+            'mqtt': {
+                'port_topic': SOAK_TOPIC_PREFIX + '/{device_id}/{port_id}',
+                'batch_topic': SOAK_BATCH_TOPIC,
+                'templates': SOAK_TEMPLATES,
+            },
+        }
+        self.gateway = Gateway(loop, logger, config, connector=LoopbackConnector)
+        self.samples = []  # (simulated hours, traced memory, tasks)
+
+    def _connector(self):
+        return next(iter(self.gateway.mqtt.profiles.values())).client
+
+    async def _events(self):
+        # commands from MQTT and callbacks from MegaD at the requested rate
+        connector = self._connector()
+        while True:
+            await asyncio.sleep(1 / self.args.rate)
+            try:
+                event = random.random()
+                if event < 0.45:
+                    await random.choice(self.fakes).send_callback()
+                else:
+                    topics = [t for t in connector.subscriptions if t != SOAK_BATCH_TOPIC]
+                    if not topics:
+                        continue
+                    if event < 0.95:
+                        await connector.inject(random.choice(topics), str(random.randint(0, 1)).encode('utf-8'))
+                    else:
+                        commands = []
+                        for t in random.sample(topics, min(10, len(topics))):
+                            _, device_id, port_id, _ = t.split('/')
+                            pn, _, ext = port_id[1:].partition('e')
+                            if ext or SOAK_PORTS[int(pn)][0] == 'OUT':  # only ports accepting commands
+                                commands.append([device_id, port_id, random.randint(0, 1)])
+                        await connector.inject(SOAK_BATCH_TOPIC, json.dumps(commands).encode('utf-8'))
+            except Exception as e:
+                self.logger.warning(f'Soak event failed. Exception type: {type(e)} message: {e}')
+
+    def _sample(self, started):
+        gc.collect()
+        memory = tracemalloc.get_traced_memory()[0]
+        tasks = len(asyncio.all_tasks(self.loop))
+        hours = (time.monotonic() - started) * self.args.speed / 3600
+        self.samples.append((hours, memory, tasks))
+        self.logger.info(f'Simulated {hours:7.1f} h: memory {memory / 1024:9.1f} KiB, tasks {tasks:4d}, '
+                         f'disabled devices {len(self.gateway.megad.devices.disabled_devices)}, '
+                         f'state pooling {len(self.gateway.megad.state_pooling)}, '
+                         f'published {self._connector().published}')
+
+    def _growth(self, values):
+        # least squares slope over samples, extrapolated to the whole run
+        n = len(values)
+        mean_x, mean_y = (n - 1) / 2, sum(values) / n
+        slope = sum((x - mean_x) * (y - mean_y) for x, y in enumerate(values)) / \
+            sum((x - mean_x) ** 2 for x in range(n))
+        return slope * (n - 1)
+
+    def check(self):
+        measured = self.samples[len(self.samples) // 4:]  # first quarter is warm-up
+        if len(measured) < 3:
+            self.logger.error('Too few samples to check growth')
+            return False
+        memory_growth = self._growth([memory for _, memory, _ in measured])
+        tasks_growth = self._growth([tasks for _, _, tasks in measured])
+        self.logger.info(f'Memory growth after warm-up: {memory_growth / 1024:.1f} KiB '
+                         f'(limit {self.args.max_memory_growth / 1024:.1f} KiB), '
+                         f'tasks growth: {tasks_growth:.1f} (limit {self.args.max_tasks_growth})')
+        result = True
+        if memory_growth > self.args.max_memory_growth:
+            self.logger.error('Memory keeps growing')
+            result = False
+        if tasks_growth > self.args.max_tasks_growth:
+            self.logger.error('Tasks count keeps growing')
+            result = False
+        return result
+
+    async def run(self):
+        for fake in self.fakes:
+            await fake.start()
+        await self.gateway.start()
+        events = self.loop.create_task(self._events())
+        tracemalloc.start(10)
+        started = time.monotonic()
+        baseline = None
+        try:
+            for idx in range(self.args.samples):
+                await asyncio.sleep(self.duration / self.args.samples)
+                self._sample(started)
+                if idx == self.args.samples // 4:
+                    baseline = tracemalloc.take_snapshot()
+            if baseline is not None:
+                top = tracemalloc.take_snapshot().compare_to(baseline, 'lineno')[:10]
+                self.logger.info('Top memory differences after warm-up:\n' + '\n'.join(str(stat) for stat in top))
+        finally:
+            tracemalloc.stop()
+            events.cancel()
+            await self.gateway.stop()
+            await cancel_tasks(self.loop)
+            for fake in self.fakes:
+                await fake.stop()
+        return self.check()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Soak test of MegaD-MQTT gateway against local stand-ins.')
+    parser.add_argument('--days', type=float, default=3, help='simulated duration in days')
+    parser.add_argument('--speed', type=float, default=2000, help='simulated seconds per real second')
+    parser.add_argument('--devices', type=int, default=4, help='number of MegaD stand-ins')
+    parser.add_argument('--rate', type=float, default=200, help='MQTT commands and MegaD callbacks per real second')
+    parser.add_argument('--samples', type=int, default=24, help='number of memory and tasks samples')
+    parser.add_argument('--port', type=int, default=29780, help='gateway HTTP port, stand-ins use following ports')
+    parser.add_argument('--max-memory-growth', type=int, default=1024 * 1024, help='allowed memory growth, bytes')
+    parser.add_argument('--max-tasks-growth', type=int, default=10, help='allowed growth of live tasks count')
+    parser.add_argument('--debug', action='store_true', default=False, help='output gateway debug messages')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
+    logging.getLogger('aiohttp.access').setLevel(logging.WARNING)
+
+    loop = asyncio.get_event_loop()
+    soak = Soak(loop, logger, args)
+    result = loop.run_until_complete(soak.run())
+    loop.close()
+    sys.exit(0 if result else 1)
+
+
+if __name__ == '__main__':
+    main()
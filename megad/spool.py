@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+import asyncio
+import os
+import struct
+
+############################################################################
+#          Append-only disk spool for MQTT messages during outages         #
+############################################################################
+
+
+SPOOL_DEFAULT_MAX_SIZE = 1024 * 1024  # bytes
+SPOOL_DEFAULT_RATE = 50  # messages per second
+SPOOL_LOW_WATER = 0.5  # share of max_size left after dropping the oldest messages, so compaction is not repeated soon
+
+_HEADER = struct.Struct('<BBHI')  # retain, qos, topic length, payload length
+
+
+class Spool(object):
+    def __init__(self, loop, logger, config, async_publish, is_connected):
+        self.loop = loop
+        self.logger = logger
+
+        self.path = config['path']
+        self.max_size = int(config.get('max_size', SPOOL_DEFAULT_MAX_SIZE))
+        self.rate = float(config.get('rate', SPOOL_DEFAULT_RATE))
+        self.async_publish = async_publish
+        self.is_connected = is_connected
+
+        self.size = 0  # bytes in spool file
+        self.pending = 0  # messages waiting for publishing
+        self.dropped = 0  # messages dropped since the spool became full, reset when it is flushed
+        self._head = 0  # offset of the first message not published yet
+        self._retained = {}  # topic -> offset of the latest message for retained topics
+        self._flush_task = None
+        self._fd = None
+        self._open()
+        if self.pending:
+            self.logger.info(f'MQTT spool {self.path} loaded with {self.pending} messages')
+
+    def _open(self):
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = os.fstat(self._fd).st_size
+        self._head = 0
+        self._retained = {}
+        self.pending = 0
+        end = 0
+        for offset, next_offset, retain, qos, topic, payload in self._records(0):
+            self._index(offset, retain, topic)
+            end = next_offset
+        if end != self.size:
+            self.logger.warning(f'MQTT spool {self.path} has incomplete record at offset {end}. Truncated')
+            os.ftruncate(self._fd, end)
+            self.size = end
+
+    def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _index(self, offset, retain, topic):
+        if retain:
+            if topic in self._retained:
+                self.pending -= 1  # previous value for this topic is superseded
+            self._retained[topic] = offset
+        self.pending += 1
+
+    def _is_live(self, offset, retain, topic):
+        return not retain or self._retained.get(topic) == offset
+
+    def _records(self, offset):
+        while offset + _HEADER.size <= self.size:
+            retain, qos, topic_len, payload_len = _HEADER.unpack(os.pread(self._fd, _HEADER.size, offset))
+            next_offset = offset + _HEADER.size + topic_len + payload_len
+            if next_offset > self.size:
+                return
+            body = os.pread(self._fd, topic_len + payload_len, offset + _HEADER.size)
+            yield offset, next_offset, bool(retain), qos, body[:topic_len].decode('utf-8'), body[topic_len:]
+            offset = next_offset
+
+    def _compact(self, need):
+        # drop published and superseded messages, and if still there is no room for `need` bytes,
+        # the oldest ones down to the low-water mark
+        live_size = sum(next_offset - offset for offset, next_offset, retain, _, topic, _ in self._records(self._head)
+                        if self._is_live(offset, retain, topic))
+        skip = 0
+        if live_size + need > self.max_size:
+            skip = live_size + need - int(self.max_size * SPOOL_LOW_WATER)
+        dropped = 0
+        tmp_path = self.path + '.tmp'
+        tmp_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            for offset, next_offset, retain, _, topic, _ in self._records(self._head):
+                if not self._is_live(offset, retain, topic):
+                    continue
+                if skip > 0:
+                    skip -= next_offset - offset
+                    dropped += 1
+                    continue
+                os.write(tmp_fd, os.pread(self._fd, next_offset - offset, offset))
+        finally:
+            os.close(tmp_fd)
+        os.close(self._fd)
+        os.replace(tmp_path, self.path)
+        self._open()
+        if dropped:
+            if not self.dropped:
+                self.logger.warning(f'MQTT spool {self.path} is full. Oldest messages are dropped until it is flushed')
+            self.dropped += dropped
+
+    def put(self, topic, payload, qos, retain):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        topic_raw = topic.encode('utf-8')
+        record = _HEADER.pack(int(retain), qos, len(topic_raw), len(payload)) + topic_raw + payload
+        if self.size + len(record) > self.max_size:
+            self._compact(len(record))
+            if self.size + len(record) > self.max_size:
+                self.logger.warning(f'MQTT spool {self.path} is too small for message to topic {topic}. Dropped')
+                return
+        os.write(self._fd, record)
+        self._index(self.size, retain, topic)
+        self.size += len(record)
+
+    def flush(self):
+        if self._flush_task is None and self.pending:
+            self.logger.info(f'Flushing {self.pending} spooled MQTT messages ({self.size} bytes)')
+            self._flush_task = self.loop.create_task(self._flush())
+
+    async def _flush(self):
+        try:
+            while self._head < self.size:
+                if not self.is_connected():
+                    self.logger.info(f'MQTT spool flushing interrupted. {self.pending} messages left')
+                    return
+                offset, next_offset, retain, qos, topic, payload = next(self._records(self._head))
+                self._head = next_offset
+                if self._is_live(offset, retain, topic):
+                    if retain:
+                        del self._retained[topic]
+                    self.pending -= 1
+                    await self.async_publish(topic, payload, qos, retain)
+                    if self.rate > 0:
+                        await asyncio.sleep(1 / self.rate)
+            os.ftruncate(self._fd, 0)
+            self.size, self._head = 0, 0
+            if self.dropped:
+                self.logger.warning(f'MQTT spool flushed. {self.dropped} oldest messages were dropped while it was full')
+                self.dropped = 0
+            else:
+                self.logger.info('MQTT spool flushed')
+        except Exception as e:
+            self.logger.exception(f'Exception on MQTT spool flushing. Exception type: {type(e)} message: {e}')
+        finally:
+            self._flush_task = None